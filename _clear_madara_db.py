@@ -1,89 +1,366 @@
+import argparse
+import logging
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from _db import Database
+from _db import Database, get_chunks, get_in
+from checkpoint import Checkpoint
+from comic import ITEM_DETAIL, _comic
+from fingerprint import _fingerprint
+from helper import IMAGE_HASH_PATH, helper, s3
+from madara import Madara
+from s3_manifest import _s3_manifest
 from settings import CONFIG
 
-database = Database()
+logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=logging.INFO)
 
+# Ids per DELETE ... IN (...) and per transaction, small enough to keep each
+# binlog event and lock set short
+CLEAR_CHUNK_SIZE = getattr(CONFIG, "CLEAR_CHUNK_SIZE", 1000)
+CLEAR_FILE_WORKERS = getattr(CONFIG, "CLEAR_FILE_WORKERS", 16)
 
-def delete_saved_images():
-    files = os.listdir(CONFIG.IMAGE_SAVE_PATH)
-    for file in files:
-        path = f"{CONFIG.IMAGE_SAVE_PATH}{file}"
-        if os.path.isdir(path):
-            shutil.rmtree(path)
+database = Database()
+_madara = Madara(database=database)
 
-    files = os.listdir(CONFIG.THUMB_SAVE_PATH)
-    for file in files:
-        path = f"{CONFIG.THUMB_SAVE_PATH}/{file}"
-        if os.path.isfile(path):
-            os.remove(path)
 
+def select_ids(table: str, column: str, condition: str, params: tuple = ()) -> list:
+    rows = database.select_all_from(
+        table=table, condition=condition, cols=column, params=params
+    )
+    return [row[0] for row in rows]
 
-def main():
-    delete_saved_images()
 
-    database.delete_from(table=f"manga_chapters_data")
+def count(table: str, condition: str = "1=1", params: tuple = ()) -> int:
+    return database.select_all_from(
+        table=table, condition=condition, cols="COUNT(*)", params=params
+    )[0][0]
+
 
-    post_ids = database.select_all_from(
-        table=f"posts", condition='post_type="wp-manga"', cols="ID"
+def count_in(table: str, column: str, ids: list, condition: str = "1=1") -> int:
+    return sum(
+        count(table, f"{condition} AND {get_in(column, chunk)}", tuple(chunk))
+        for chunk in get_chunks(ids, CLEAR_CHUNK_SIZE)
     )
-    post_ids = [x[0] for x in post_ids]
 
-    for post_id in post_ids:
-        database.delete_from(
-            table=f"manga_volumes",
-            condition=f'post_id="{post_id}"',
+
+def get_thumbnail_ids(post_ids: list) -> list:
+    thumbnail_ids = []
+    for chunk in get_chunks(post_ids, CLEAR_CHUNK_SIZE):
+        thumbnail_ids += select_ids(
+            "postmeta",
+            "meta_value",
+            f"meta_key = %s AND {get_in('post_id', chunk)}",
+            ("_thumbnail_id", *chunk),
         )
-        database.delete_from(
-            table=f"manga_chapters",
-            condition=f'post_id="{post_id}"',
+    return [int(thumbnail_id) for thumbnail_id in thumbnail_ids]
+
+
+def get_chapter_ids(post_ids: list) -> list:
+    chapter_ids = []
+    for chunk in get_chunks(post_ids, CLEAR_CHUNK_SIZE):
+        chapter_ids += select_ids(
+            "manga_chapters", "chapter_id", get_in("post_id", chunk), tuple(chunk)
         )
+    return chapter_ids
 
-        _thumbnail_id = database.select_all_from(
-            table=f"postmeta",
-            condition=f'post_id={post_id} AND meta_key="_thumbnail_id"',
+
+def get_chapter_post_ids(chapter_ids: list) -> list:
+    chapter_post_ids = []
+    for chunk in get_chunks(chapter_ids, CLEAR_CHUNK_SIZE):
+        chapter_post_ids += select_ids(
+            "posts",
+            "ID",
+            f"post_type = %s AND {get_in('post_parent', chunk)}",
+            ("chapter_text_content", *chunk),
         )
-        if _thumbnail_id:
-            database.delete_from(
-                table=f"posts",
-                condition=f"ID={_thumbnail_id[0][-1]}",
-            )
+    return chapter_post_ids
 
+
+def get_orphan_chapter_post_ids() -> list:
+    # Chapter contents whose chapter row is already gone
+    return select_ids(
+        "posts",
+        "ID",
+        f"post_type = %s AND NOT EXISTS (SELECT 1 FROM "
+        f"{CONFIG.TABLE_PREFIX}manga_chapters c "
+        f"WHERE c.chapter_id = {CONFIG.TABLE_PREFIX}posts.post_parent)",
+        ("chapter_text_content",),
+    )
+
+
+def delete_comic_rows(post_ids: list, thumbnail_ids: list, chapter_ids: list):
+    # Only called inside a transaction, the deletes are committed together
+    chapter_post_ids = get_chapter_post_ids(chapter_ids)
+    all_post_ids = post_ids + thumbnail_ids + chapter_post_ids
+
+    for chunk in get_chunks(all_post_ids, CLEAR_CHUNK_SIZE):
+        database.delete_from("postmeta", get_in("post_id", chunk), tuple(chunk))
+    for chunk in get_chunks(post_ids, CLEAR_CHUNK_SIZE):
         database.delete_from(
-            table=f"postmeta",
-            condition=f'post_id="{post_id}"',
+            "term_relationships", get_in("object_id", chunk), tuple(chunk)
         )
-
+        database.delete_from("manga_volumes", get_in("post_id", chunk), tuple(chunk))
+    for chunk in get_chunks(chapter_ids, CLEAR_CHUNK_SIZE):
         database.delete_from(
-            table=f"term_relationships",
-            condition=f'object_id="{post_id}"',
+            "manga_chapters", get_in("chapter_id", chunk), tuple(chunk)
         )
+    for chunk in get_chunks(all_post_ids, CLEAR_CHUNK_SIZE):
+        database.delete_from("posts", get_in("ID", chunk), tuple(chunk))
 
-        database.delete_from(
-            table=f"posts",
-            condition=f'ID="{post_id}"',
+
+def clear_comics(dry_run: bool) -> None:
+    post_ids = select_ids("posts", "ID", "post_type = %s", ("wp-manga",))
+
+    if dry_run:
+        thumbnail_ids = get_thumbnail_ids(post_ids)
+        logging.info(f"[=] posts wp-manga: {len(post_ids)}")
+        logging.info(f"[=] posts thumbnails: {len(thumbnail_ids)}")
+        logging.info(
+            "[=] posts chapter_text_content: "
+            f"{count('posts', 'post_type = %s', ('chapter_text_content',))}"
+        )
+        logging.info(
+            "[=] postmeta: "
+            f"{count_in('postmeta', 'post_id', post_ids + thumbnail_ids)}"
+        )
+        logging.info(
+            "[=] term_relationships: "
+            f"{count_in('term_relationships', 'object_id', post_ids)}"
         )
+        logging.info(
+            f"[=] manga_volumes: {count_in('manga_volumes', 'post_id', post_ids)}"
+        )
+        logging.info(
+            f"[=] manga_chapters: {count_in('manga_chapters', 'post_id', post_ids)}"
+        )
+        logging.info(f"[=] manga_chapters_data: {count('manga_chapters_data')}")
+        return
+
+    database.delete_from(table="manga_chapters_data")
+
+    chunks = get_chunks(post_ids, CLEAR_CHUNK_SIZE)
+    for i, chunk in enumerate(chunks, 1):
+        with database.transaction():
+            delete_comic_rows(chunk, get_thumbnail_ids(chunk), get_chapter_ids(chunk))
+        logging.info(f"[+] Deleted comics chunk {i}/{len(chunks)}")
 
+    # Selected once the comics are gone, so only the real orphans are left
+    for chunk in get_chunks(get_orphan_chapter_post_ids(), CLEAR_CHUNK_SIZE):
+        with database.transaction():
+            database.delete_from("postmeta", get_in("post_id", chunk), tuple(chunk))
+            database.delete_from("posts", get_in("ID", chunk), tuple(chunk))
+
+
+def clear_terms(dry_run: bool) -> None:
     term_taxonomies = database.select_all_from(
-        table=f"term_taxonomy",
-        condition='taxonomy LIKE "wp-manga%"',
+        table="term_taxonomy",
+        condition="taxonomy LIKE %s",
         cols="term_taxonomy_id, term_id",
+        params=("wp-manga%",),
     )
+    term_taxonomy_ids = [row[0] for row in term_taxonomies]
+    term_ids = [row[1] for row in term_taxonomies]
 
-    for term_taxonomy in term_taxonomies:
-        term_taxonomy_id, term_id = term_taxonomy
+    if dry_run:
+        logging.info(f"[=] term_taxonomy wp-manga%: {len(term_taxonomy_ids)}")
+        logging.info(f"[=] terms: {len(set(term_ids))}")
+        return
 
-        database.delete_from(
-            table=f"term_taxonomy",
-            condition=f"term_taxonomy_id={term_taxonomy_id}",
-        )
+    for taxonomy_chunk, term_chunk in zip(
+        get_chunks(term_taxonomy_ids, CLEAR_CHUNK_SIZE),
+        get_chunks(term_ids, CLEAR_CHUNK_SIZE),
+    ):
+        with database.transaction():
+            database.delete_from(
+                "term_relationships",
+                get_in("term_taxonomy_id", taxonomy_chunk),
+                tuple(taxonomy_chunk),
+            )
+            database.delete_from(
+                "term_taxonomy",
+                get_in("term_taxonomy_id", taxonomy_chunk),
+                tuple(taxonomy_chunk),
+            )
+            # A term shared with another taxonomy (seasons, tags...) stays
+            database.delete_from(
+                "terms",
+                f"{get_in('term_id', term_chunk)} AND term_id NOT IN "
+                f"(SELECT term_id FROM {CONFIG.TABLE_PREFIX}term_taxonomy)",
+                tuple(term_chunk),
+            )
 
-        database.delete_from(
-            table=f"terms",
-            condition=f"term_id={term_id}",
+
+def get_saved_paths() -> list:
+    paths = []
+    for folder in [CONFIG.IMAGE_SAVE_PATH, CONFIG.THUMB_SAVE_PATH, IMAGE_HASH_PATH]:
+        if folder and os.path.isdir(folder):
+            paths += [os.path.join(folder, file) for file in os.listdir(folder)]
+    # The thumbnail folder may live inside IMAGE_SAVE_PATH
+    return [
+        path
+        for path in sorted(set(paths))
+        if os.path.normpath(path) != os.path.normpath(CONFIG.THUMB_SAVE_PATH)
+    ]
+
+
+def delete_path(path: str) -> None:
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+
+def delete_saved_images(dry_run: bool) -> None:
+    paths = get_saved_paths()
+    if dry_run:
+        logging.info(f"[=] Saved comic folders / thumbnails: {len(paths)}")
+        return
+
+    # rmtree is bound by filesystem calls, not the GIL
+    step = max(1, len(paths) // 20)
+    with ThreadPoolExecutor(max_workers=CLEAR_FILE_WORKERS) as executor:
+        futures = [executor.submit(delete_path, path) for path in paths]
+        for i, future in enumerate(as_completed(futures), 1):
+            future.result()
+            if i % step == 0 or i == len(paths):
+                logging.info(f"[+] Deleted {i}/{len(paths)} folders / files")
+
+    # Fingerprints and the crawl_all.py checkpoint would make the crawler skip
+    # comics that no longer exist
+    _fingerprint.clear()
+    _s3_manifest.clear()
+    Checkpoint().clear()
+
+
+def get_hash_paths(paths: list) -> set:
+    # Store entries of the hardlinked images under paths, read before they go
+    hash_paths = set()
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for file in files:
+                file_path = os.path.join(root, file)
+                if os.stat(file_path).st_nlink > 1:
+                    hash_paths.add(
+                        helper.get_hash_path(helper.get_file_hash(file_path))
+                    )
+    return hash_paths
+
+
+def delete_unlinked_hashes(hash_paths: set) -> int:
+    # An entry left with a single link is no longer used by any chapter
+    deleted = 0
+    for hash_path in hash_paths:
+        try:
+            if os.stat(hash_path).st_nlink == 1:
+                os.remove(hash_path)
+                deleted += 1
+        except FileNotFoundError:
+            pass
+    return deleted
+
+
+def delete_images(image_urls: list, paths: list) -> None:
+    # Run after the rows are committed, files cannot be rolled back
+    prefix = f"{CONFIG.S3_BUCKET_IMAGE_URL_PREFIX}/"
+    keys = [url[len(prefix) :] for url in image_urls if url.startswith(prefix)]
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(
+            Bucket=CONFIG.S3_BUCKET,
+            Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]]},
         )
+    _s3_manifest.delete([os.path.splitext(key)[0] for key in keys])
+
+    hash_paths = get_hash_paths(paths)
+    for path in paths:
+        delete_path(path)
+    logging.info(f"[+] Deleted {len(keys)} S3 images and {len(paths)} folders / files")
+    logging.info(f"[+] Deleted {delete_unlinked_hashes(hash_paths)} stored images")
+
+
+def purge_comic(href: str, dry_run: bool) -> None:
+    # href may also be just the comic slug
+    comic_slug = _comic.get_comic_slug(href=href)
+    comic_id = _madara.get_comic_id(comic_slug)
+    if not comic_id:
+        logging.error(f"[-] Comic {comic_slug} not found")
+        return
+
+    if dry_run:
+        chapters = _madara.get_chapters(comic_id)
+        logging.info(f"[=] Comic {comic_slug} ({comic_id}): {len(chapters)} chapters")
+        return
+
+    with database.transaction():
+        cover_file, image_urls = _madara.delete_comic(comic_id)
+
+    # Crawled again from scratch the next time it shows up in a listing
+    _fingerprint.delete(comic_slug)
+    delete_images(
+        image_urls,
+        [os.path.join(CONFIG.IMAGE_SAVE_PATH, comic_slug)]
+        + ([cover_file] if cover_file else []),
+    )
+    logging.info(f"[+] Purged comic {comic_slug} ({comic_id})")
+
+
+def purge_stale_chapters(href: str, dry_run: bool) -> None:
+    comic_slug = _comic.get_comic_slug(href=href)
+    comic_id = _madara.get_comic_id(comic_slug)
+    if not comic_id:
+        logging.error(f"[-] Comic {comic_slug} not found")
+        return
+
+    soup = helper.crawl_soup(href, parse_only=ITEM_DETAIL, page_type="comic")
+    comic_details = _comic.get_comic_details(href=href, soup=soup)
+    # A page that failed to load would make every chapter look stale
+    if not comic_details.get("chapters"):
+        logging.error(f"[-] Cannot read the chapters of {href}")
+        return
+
+    source_slugs = {chapter.slug for chapter in comic_details["chapters"]}
+    stale_chapters = {
+        chapter_slug: chapter_id
+        for chapter_slug, chapter_id in _madara.get_chapters(comic_id).items()
+        if chapter_slug not in source_slugs
+    }
+    logging.info(f"[=] Stale chapters of {comic_slug}: {sorted(stale_chapters)}")
+    if dry_run or not stale_chapters:
+        return
+
+    with database.transaction():
+        image_urls = _madara.delete_chapters(comic_id, list(stale_chapters.values()))
+
+    delete_images(
+        image_urls,
+        [
+            os.path.join(CONFIG.IMAGE_SAVE_PATH, comic_slug, chapter_slug)
+            for chapter_slug in stale_chapters
+        ],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only print what would be deleted"
+    )
+    parser.add_argument("--comic", help="only delete this comic (link or slug)")
+    parser.add_argument(
+        "--stale", help="only delete the chapters no longer listed on this comic link"
+    )
+    args = parser.parse_args()
+
+    if args.comic:
+        purge_comic(args.comic, args.dry_run)
+        return
+    if args.stale:
+        purge_stale_chapters(args.stale, args.dry_run)
+        return
+
+    delete_saved_images(args.dry_run)
+    clear_comics(args.dry_run)
+    clear_terms(args.dry_run)
 
 
 if __name__ == "__main__":
@@ -1,68 +1,263 @@
+import logging
 import sys
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import monotonic, sleep
 
 import mysql.connector
+from mysql.connector import errorcode, pooling
 
+from metrics import _metrics
 from settings import CONFIG
 
+# Enough for the crawler threads that write at the same time plus one spare
+DB_POOL_SIZE = getattr(CONFIG, "DB_POOL_SIZE", 8)
+DB_RETRIES = getattr(CONFIG, "DB_RETRIES", 3)
+# Seconds a connection may sit idle before it is pinged on the next use
+DB_PING_AFTER = getattr(CONFIG, "DB_PING_AFTER", 60)
+
+TRANSIENT_ERRORS = {
+    errorcode.CR_SERVER_GONE_ERROR,
+    errorcode.CR_SERVER_LOST,
+    errorcode.CR_SERVER_LOST_EXTENDED,
+    errorcode.CR_CONN_HOST_ERROR,
+    errorcode.CR_CONNECTION_ERROR,
+    errorcode.ER_LOCK_DEADLOCK,
+    errorcode.ER_LOCK_WAIT_TIMEOUT,
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_chunks(values: list, size: int) -> list:
+    return [values[i : i + size] for i in range(0, len(values), size)]
+
+
+def get_in(column: str, values: list) -> str:
+    return f"{column} IN ({', '.join(['%s'] * len(values))})"
+
+
+def get_pool() -> pooling.MySQLConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            try:
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name="nettruyen_madara",
+                    pool_size=DB_POOL_SIZE,
+                    pool_reset_session=False,
+                    # Connections live as long as the process, a read outside
+                    # transaction() must not hold a REPEATABLE READ snapshot
+                    autocommit=True,
+                    user=CONFIG.user,
+                    password=CONFIG.password,
+                    host=CONFIG.host,
+                    port=CONFIG.port,
+                    database=CONFIG.database,
+                )
+            except Exception as e:
+                print(f"Error connecting to MariaDB Platform: {e}")
+                sys.exit(1)
+    return _pool
+
+
+def retry_on_disconnect(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        for attempt in range(DB_RETRIES + 1):
+            try:
+                return method(self, *args, **kwargs)
+            except mysql.connector.Error as e:
+                # A broken transaction can only be replayed by its caller
+                if (
+                    self.in_transaction
+                    or attempt == DB_RETRIES
+                    or e.errno not in TRANSIENT_ERRORS
+                ):
+                    raise
+
+                logging.warning(f"[-] Database error, retrying: {e}")
+                sleep(2**attempt)
+                self.reconnect()
+
+    return wrapper
+
+
+def time_query(method):
+    # Includes the retries, a reconnect shows up as a slow query
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with _metrics.time("crawler_sql_seconds", method=method.__name__):
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
 
 class Database:
     def __init__(self) -> None:
-        self.conn = self.get_conn()
+        # Each thread borrows its own connection from the shared pool
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        if getattr(self.local, "conn", None) is None:
+            self.local.conn = self.get_conn()
+            self.local.prepared_cursors = {}
+            self.local.in_transaction = False
+        elif monotonic() - self.local.last_used > DB_PING_AFTER:
+            # MariaDB drops idle connections after wait_timeout
+            self.local.conn.ping(reconnect=True, attempts=DB_RETRIES, delay=2)
+            self.local.prepared_cursors = {}
+
+        self.local.last_used = monotonic()
+        return self.local.conn
+
+    @property
+    def in_transaction(self) -> bool:
+        return getattr(self.local, "in_transaction", False)
+
+    @in_transaction.setter
+    def in_transaction(self, value: bool) -> None:
+        self.local.in_transaction = value
+
+    @property
+    def prepared_cursors(self) -> dict:
+        # query -> prepared cursor, so hot lookups are parsed by the server once
+        self.conn
+        return self.local.prepared_cursors
 
     def get_conn(self):
-        try:
-            return mysql.connector.connect(
-                user=CONFIG.user,
-                password=CONFIG.password,
-                host=CONFIG.host,
-                port=CONFIG.port,
-                database=CONFIG.database,
-            )
-        except Exception as e:
-            print(f"Error connecting to MariaDB Platform: {e}")
-            sys.exit(1)
-
-    def select_with(self, query: str) -> list:
+        pool = get_pool()
+        for attempt in range(DB_RETRIES + 1):
+            try:
+                return pool.get_connection()
+            except pooling.PoolError:
+                if attempt == DB_RETRIES:
+                    raise
+                logging.warning("[-] Database pool exhausted, waiting")
+                sleep(2**attempt)
+
+    def reconnect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            return
+
+        self.local.prepared_cursors = {}
+        conn.reconnect(attempts=DB_RETRIES, delay=2)
+        self.local.last_used = monotonic()
+
+    def close(self):
+        # Give this thread's connection back to the pool
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            return
+
+        self.local.conn = None
+        self.local.prepared_cursors = {}
+        conn.close()
+
+    @contextmanager
+    def transaction(self):
+        # Writes inside the block are committed once at the end, or rolled
+        # back together. Nested blocks join the outer transaction.
+        if self.in_transaction:
+            yield
+            return
+
         conn = self.conn
-        cur = conn.cursor()
-        cur.execute(query)
-        res = cur.fetchall()
-        cur.close()
-        # conn.close()
+        conn.start_transaction()
+        self.in_transaction = True
+        try:
+            yield
+            with _metrics.time("crawler_sql_seconds", method="commit"):
+                conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except mysql.connector.Error as e:
+                logging.error(f"[-] Rollback failed: {e}")
+            raise
+        finally:
+            self.in_transaction = False
 
-        return res
+    def commit(self):
+        if not self.in_transaction:
+            self.conn.commit()
+
+    def get_prepared_cursor(self, query: str):
+        cur = self.prepared_cursors.get(query)
+        if cur is None:
+            cur = self.conn.cursor(prepared=True)
+            self.prepared_cursors[query] = cur
+        return cur
+
+    @time_query
+    @retry_on_disconnect
+    def select_with(self, query: str, params: tuple = (), prepared: bool = False):
+        # Prepared cursors may return strings as bytearray, only use them for
+        # lookups of numeric ids
+        if prepared:
+            cur = self.get_prepared_cursor(query)
+            cur.execute(query, params)
+            return cur.fetchall()
 
-    def select_all_from(self, table: str, condition: str = "1=1", cols: str = "*"):
         conn = self.conn
         cur = conn.cursor()
-        cur.execute(
-            f"SELECT {cols} FROM {CONFIG.TABLE_PREFIX}{table} WHERE {condition}"
-        )
+        cur.execute(query, params)
         res = cur.fetchall()
         cur.close()
         # conn.close()
 
         return res
 
-    def insert_into(self, table: str, data: tuple = None, is_bulk: bool = False):
+    def select_all_from(
+        self,
+        table: str,
+        condition: str = "1=1",
+        cols: str = "*",
+        params: tuple = (),
+        prepared: bool = False,
+    ):
+        return self.select_with(
+            f"SELECT {cols} FROM {CONFIG.TABLE_PREFIX}{table} WHERE {condition}",
+            params=params,
+            prepared=prepared,
+        )
+
+    @time_query
+    @retry_on_disconnect
+    def insert_into(
+        self,
+        table: str,
+        data: tuple = None,
+        is_bulk: bool = False,
+        ignore: bool = False,
+    ):
         conn = self.conn
         cur = conn.cursor()
         id = 0
 
         columns = f"({', '.join(CONFIG.INSERT[table])})"
         values = f"({', '.join(['%s'] * len(CONFIG.INSERT[table]))})"
-        query = f"INSERT INTO {CONFIG.TABLE_PREFIX}{table} {columns} VALUES {values}"
+        insert = "INSERT IGNORE" if ignore else "INSERT"
+        query = f"{insert} INTO {CONFIG.TABLE_PREFIX}{table} {columns} VALUES {values}"
         if is_bulk:
-            cur.executemany(query, data)
+            # mysql-connector rewrites this into a single multi-row INSERT
+            if data:
+                cur.executemany(query, data)
         else:
             cur.execute(query, data)
             id = cur.lastrowid
 
-        conn.commit()
+        self.commit()
         cur.close()
         # conn.close()
         return id
 
+    @time_query
+    @retry_on_disconnect
     def update_table(
         self, table: str, set_cond: str, where_cond: str, data: tuple = ()
     ):
@@ -72,21 +267,39 @@ class Database:
             f"UPDATE {CONFIG.TABLE_PREFIX}{table} set {set_cond} WHERE {where_cond}",
             data,
         )
-        conn.commit()
+        self.commit()
         cur.close()
         # conn.close()
 
-    def delete_from(self, table: str = "", condition: str = "1=1"):
+    @time_query
+    @retry_on_disconnect
+    def delete_from(self, table: str = "", condition: str = "1=1", params: tuple = ()):
         conn = self.conn
         cur = conn.cursor()
-        cur.execute(f"DELETE FROM {CONFIG.TABLE_PREFIX}{table} WHERE {condition}")
-        conn.commit()
+        cur.execute(
+            f"DELETE FROM {CONFIG.TABLE_PREFIX}{table} WHERE {condition}", params
+        )
+        self.commit()
         cur.close()
         # conn.close()
 
-    def select_or_insert(self, table: str, condition: str, data: tuple):
-        res = self.select_all_from(table=table, condition=condition)
+    def select_or_insert(
+        self,
+        table: str,
+        condition: str,
+        data: tuple,
+        params: tuple = (),
+        cols: str = "*",
+        prepared: bool = False,
+    ):
+        res = self.select_all_from(
+            table=table,
+            condition=condition,
+            cols=cols,
+            params=params,
+            prepared=prepared,
+        )
         if not res:
-            self.insert_into(table, data)
-            res = self.select_all_from(table, condition=condition)
+            # Only the id of the new row is known without a second select
+            res = [(self.insert_into(table, data),)]
         return res
@@ -0,0 +1,328 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import httpx
+from bs4 import BeautifulSoup, SoupStrainer
+
+from chapter import CHAPTER_CENTER, ChapterRecord, _chapter
+from checkpoint import Checkpoint
+from comic import ITEM_DETAIL, _comic
+from crawler import LISTING, Crawler
+from fingerprint import _fingerprint
+from helper import HTTP_POOL_SIZE, helper
+from http_cache import _http_cache
+from madara import Madara
+from rate_limiter import RATE_LIMIT_RETRIES, RETRY_STATUSES, _rate_limiter
+from settings import CONFIG
+
+logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=logging.INFO)
+
+ASYNC_PAGE_WORKERS = getattr(CONFIG, "ASYNC_PAGE_WORKERS", 4)
+ASYNC_COMIC_WORKERS = getattr(CONFIG, "ASYNC_COMIC_WORKERS", 8)
+ASYNC_CHAPTER_WORKERS = getattr(CONFIG, "ASYNC_CHAPTER_WORKERS", 8)
+ASYNC_IMAGE_WORKERS = getattr(CONFIG, "ASYNC_IMAGE_WORKERS", 32)
+
+
+class AsyncCrawler(Crawler):
+    def __init__(
+        self,
+        database,
+        checkpoint: Checkpoint = None,
+        madara: Madara = None,
+        newest_first: bool = False,
+    ) -> None:
+        super().__init__(
+            database=database,
+            checkpoint=checkpoint,
+            madara=madara,
+            newest_first=newest_first,
+        )
+        # Every database call goes through this single thread, so writes are
+        # applied one at a time in submission order on the one connection
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        # Images and covers block on their downloads and on the rate limiter,
+        # so they get their own threads instead of the loop's default executor
+        # that parse_soup runs on
+        self.image_executor = ThreadPoolExecutor(
+            max_workers=ASYNC_IMAGE_WORKERS, thread_name_prefix="async-image"
+        )
+        self.client = None
+
+    async def run_db(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.db_executor, partial(func, *args, **kwargs)
+        )
+
+    async def run_image(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.image_executor, partial(func, *args, **kwargs)
+        )
+
+    async def async_get(self, url: str, **kwargs) -> httpx.Response:
+        # Same per-host limit as Helper.download_url, awaited instead of slept
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            await asyncio.sleep(_rate_limiter.reserve(url))
+            try:
+                response = await self.client.get(url, **kwargs)
+            except httpx.HTTPError:
+                helper.record_response(url)
+                raise
+
+            helper.record_response(
+                url,
+                response.status_code,
+                response.elapsed.total_seconds(),
+                response.headers,
+            )
+            is_last_attempt = attempt == RATE_LIMIT_RETRIES
+            if response.status_code not in RETRY_STATUSES or is_last_attempt:
+                return response
+
+    async def async_download_page(self, url: str, page_type: str) -> bytes:
+        content = _http_cache.get_fresh(url, page_type)
+        if content is not None:
+            return content
+
+        response = await self.async_get(
+            url, headers=_http_cache.get_conditional_headers(url)
+        )
+        if response.status_code == 304:
+            content = _http_cache.revalidated(url)
+            if content is not None:
+                return content
+            response = await self.async_get(url)
+
+        if response.status_code == 200:
+            _http_cache.store(url, response.headers, response.content, page_type)
+
+        return response.content
+
+    async def async_crawl_soup(
+        self, url: str, parse_only: SoupStrainer = None, page_type: str = ""
+    ) -> BeautifulSoup:
+        logging.info(f"[+] Crawling {url}")
+
+        html = await self.async_download_page(url, page_type=page_type)
+        return await asyncio.to_thread(
+            helper.parse_soup, html, parse_only=parse_only, page_type=page_type
+        )
+
+    async def async_download_image(self, **kwargs) -> str:
+        async with self.image_slots:
+            try:
+                return await self.run_image(
+                    self._madara.download_chapter_image, **kwargs
+                )
+            except Exception as e:
+                logging.error(f"[-] Failed image {kwargs.get('image_src')}: {e}")
+                return ""
+
+    async def async_crawl_chapter(
+        self,
+        comic_title: str,
+        comic_id: int,
+        comic_slug: str,
+        chapter: ChapterRecord,
+    ) -> bool:
+        async with self.chapter_slots:
+            soup = await self.async_crawl_soup(
+                chapter.href, parse_only=CHAPTER_CENTER, page_type="chapter"
+            )
+
+        chapter_details = _chapter.get_chapter_detail(
+            chapter_name=chapter.name, soup=soup
+        )
+
+        image_numbers = list(chapter_details.keys())
+        saved_images = await asyncio.gather(
+            *(
+                self.async_download_image(
+                    comic_slug=comic_slug,
+                    chapter_slug=chapter.slug,
+                    image_number=image_number,
+                    image_src=chapter_details[image_number].get("src"),
+                )
+                for image_number in image_numbers
+            )
+        )
+
+        content, failed_images = self._madara.get_chapter_content(
+            comic_title=comic_title,
+            chapter_name=chapter.name,
+            chapter_details=chapter_details,
+            saved_images=dict(zip(image_numbers, saved_images)),
+        )
+        if failed_images:
+            helper.error_log(
+                msg=f"Failed images for {chapter.href}\n" + "\n".join(failed_images),
+                filename="crawler.crawl_chapter.log",
+            )
+            logging.error(
+                f"[-] {len(failed_images)} images failed, skipped {chapter.name}"
+            )
+            return False
+
+        is_inserted = await self.run_db(
+            self._madara.insert_chapter,
+            comic_id=comic_id,
+            chapter=chapter,
+            content=content,
+        )
+        if not is_inserted:
+            return False
+
+        logging.info(f"Inserted {chapter.name}")
+        return True
+
+    async def async_crawl_comic(self, href: str, listing_fingerprint: str = "") -> bool:
+        async with self.comic_slots:
+            soup = await self.async_crawl_soup(
+                href, parse_only=ITEM_DETAIL, page_type="comic"
+            )
+
+        comic_details = _comic.get_comic_details(href=href, soup=soup)
+        if not comic_details:
+            logging.error(f"Cannot crawl comic with: {href}")
+            return False
+
+        comic_slug = _comic.get_comic_slug(href=href)
+        chapters_fingerprint = self.get_chapters_fingerprint(
+            comic_details.get("chapters", [])
+        )
+        if _fingerprint.get(comic_slug)[1] == chapters_fingerprint:
+            _fingerprint.set(comic_slug, listing_fingerprint, chapters_fingerprint)
+            return True
+
+        comic_id = await self.run_db(self._madara.get_comic_id, comic_details["slug"])
+        if not comic_id:
+            async with self.image_slots:
+                thumb = await self.run_image(self._madara.get_thumb, comic_details)
+            comic_id = await self.run_db(
+                self._madara.get_or_insert_comic, comic_details, thumb
+            )
+        logging.info(f"Got (or inserted) comic: {comic_id}")
+
+        if not comic_id:
+            logging.error(f"Cannot crawl comic with: {href}")
+            return False
+
+        chapters = comic_details.get("chapters", [])
+        inserted_chapters_slug = await self.run_db(
+            self._madara.get_backend_chapters_slug,
+            comic_id,
+            [chapter.slug for chapter in chapters],
+        )
+
+        results = await asyncio.gather(
+            *(
+                self.async_crawl_chapter(
+                    comic_title=comic_details.get("title"),
+                    comic_id=comic_id,
+                    comic_slug=comic_details.get("slug"),
+                    chapter=chapter,
+                )
+                for chapter in self.get_missing_chapters(
+                    chapters, inserted_chapters_slug
+                )
+            )
+        )
+
+        is_completed = all(results)
+        if is_completed:
+            _fingerprint.set(comic_slug, listing_fingerprint, chapters_fingerprint)
+
+        return is_completed
+
+    async def async_crawl_comic_safe(self, href: str, listing_fingerprint: str) -> None:
+        try:
+            if await self.async_crawl_comic(
+                href=href, listing_fingerprint=listing_fingerprint
+            ):
+                self.mark_comic_done(href)
+        except Exception as e:
+            logging.error(f"[-] Failed to crawl comic {href}: {e}")
+
+    async def async_crawl_page(self, page: int = 1) -> int:
+        url = f"{CONFIG.NETTRUYEN_HOMEPAGE}/?page={page}"
+        soup = await self.async_crawl_soup(url, parse_only=LISTING, page_type="listing")
+
+        div_items = soup.find("div", class_="items")
+        if not div_items:
+            return 0
+
+        comics = []
+        for item in div_items.find_all("div", class_="item"):
+            href = self.get_item_href(item=item)
+            if not href:
+                logging.error("[-] Could not find href for item")
+                continue
+
+            listing_fingerprint = self.get_item_fingerprint(item=item)
+            if self.is_comic_done(href) or self.is_item_unchanged(
+                href, listing_fingerprint
+            ):
+                logging.info(f"[=] Unchanged {href}")
+                continue
+
+            comics.append((href, listing_fingerprint))
+
+        await asyncio.gather(
+            *(
+                self.async_crawl_comic_safe(href, listing_fingerprint)
+                for href, listing_fingerprint in comics
+            )
+        )
+
+        return 1
+
+    async def page_worker(self, pages: asyncio.Queue) -> None:
+        while True:
+            page = await pages.get()
+            try:
+                await self.async_crawl_page(page=page)
+                if self.checkpoint:
+                    self.checkpoint.mark_page_done(page)
+            except Exception as e:
+                logging.error(f"[-] Failed to crawl page {page}: {e}")
+            finally:
+                pages.task_done()
+
+    async def crawl_pages(self, pages: list) -> None:
+        self.comic_slots = asyncio.Semaphore(ASYNC_COMIC_WORKERS)
+        self.chapter_slots = asyncio.Semaphore(ASYNC_CHAPTER_WORKERS)
+        self.image_slots = asyncio.Semaphore(ASYNC_IMAGE_WORKERS)
+
+        limits = httpx.Limits(
+            max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE
+        )
+        async with httpx.AsyncClient(
+            headers=helper.get_header(),
+            limits=limits,
+            timeout=httpx.Timeout(60, connect=10),
+            follow_redirects=True,
+        ) as client:
+            self.client = client
+
+            queue = asyncio.Queue()
+            for page in pages:
+                queue.put_nowait(page)
+
+            workers = [
+                asyncio.create_task(self.page_worker(queue))
+                for _ in range(ASYNC_PAGE_WORKERS)
+            ]
+            await queue.join()
+            for worker in workers:
+                worker.cancel()
+
+    def run(self, pages: list) -> None:
+        try:
+            asyncio.run(self.crawl_pages(pages=pages))
+        finally:
+            # Return the writer thread's connection to the pool
+            self.db_executor.submit(self._madara.database.close).result()
+            self.db_executor.shutdown()
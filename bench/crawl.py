@@ -0,0 +1,123 @@
+"""Offline crawler throughput against recorded fixtures.
+
+Record fixtures first (python -m bench.record), then
+python -m bench.crawl --latency 0.05 --error-rate 0.01
+
+Every scenario runs on a fresh SQLite stand-in for MariaDB and a temporary
+image folder, with HTTP answered by a local stub server.
+"""
+import argparse
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+import crawler as crawler_module
+import helper as helper_module
+import madara
+import rate_limiter
+from bench.stub import SqliteDatabase, StubServer, install_stub, load_index
+from chapter import _chapter
+from crawler import Crawler
+from fingerprint import Fingerprint
+from http_cache import HttpCache
+from settings import CONFIG
+
+
+def crawl_chapters(_crawler: Crawler, index: dict):
+    comic_ids = {}
+    for chapter in index["chapters"]:
+        comic_id = comic_ids.setdefault(chapter["comic_slug"], len(comic_ids) + 1)
+        _crawler.crawl_chapter(
+            comic_title=chapter["comic_title"],
+            comic_id=comic_id,
+            comic_slug=chapter["comic_slug"],
+            chapter=_chapter.get_chapter_record(chapter["name"], chapter["href"]),
+        )
+
+
+def crawl_comics(_crawler: Crawler, index: dict):
+    for href in index["comics"]:
+        _crawler.crawl_comic(href=href)
+
+
+def crawl_pages(_crawler: Crawler, index: dict):
+    for page in range(1, len(index["listing"]) + 1):
+        _crawler.crawl_page(page=page)
+
+
+SCENARIOS = {
+    "crawl_chapter": crawl_chapters,
+    "crawl_comic": crawl_comics,
+    "crawl_page": crawl_pages,
+}
+
+
+def run_scenario(name: str, server: StubServer, index: dict, workdir: Path) -> dict:
+    # Fresh database, caches, fingerprints and HTTP cache so nothing is skipped
+    database = SqliteDatabase()
+    madara.chapters_slug_cache.clear()
+    madara.terms_cache.clear()
+    # and host rates, so a scenario does not inherit the last one's backoff
+    rate_limiter._rate_limiter.hosts.clear()
+    crawler_module._fingerprint = Fingerprint(str(workdir / f"{name}.sqlite3"))
+    helper_module._http_cache = HttpCache(str(workdir / name / "http_cache"))
+    CONFIG.IMAGE_SAVE_PATH = str(workdir / name / "images")
+    CONFIG.THUMB_SAVE_PATH = str(workdir / name / "covers")
+
+    server.reset_counters()
+    start = perf_counter()
+    SCENARIOS[name](Crawler(database=database), index)
+    elapsed = perf_counter() - start
+
+    chapters = database.count("manga_chapters")
+    pages = sum(
+        server.requests.get(kind, 0) for kind in ("listing", "comic", "chapter")
+    )
+    return {
+        "scenario": name,
+        "seconds": elapsed,
+        "pages/s": pages / elapsed,
+        "chapters/s": chapters / elapsed,
+        "images/s": server.requests.get("image", 0) / elapsed,
+        "sql/chapter": database.statements / chapters if chapters else 0,
+        "http errors": server.errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--scenario", choices=list(SCENARIOS), action="append", default=[]
+    )
+    args = parser.parse_args()
+
+    index = load_index()
+    server = StubServer(index, latency=args.latency, error_rate=args.error_rate)
+    install_stub(server.start().url)
+    CONFIG.NETTRUYEN_HOMEPAGE = index["homepage"]
+    CONFIG.SAVE_CHAPTER_IMAGES_TO_S3 = False
+    # Measure the crawler, not the per-host pacing meant for the real site
+    rate_limiter.RATE_LIMIT_INITIAL = 1_000_000
+    rate_limiter.RATE_LIMIT_MAX = 1_000_000
+    rate_limiter.RATE_LIMIT_BURST = 1_000
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.scenario or list(SCENARIOS):
+            results.append(run_scenario(name, server, index, Path(workdir)))
+
+    columns = list(results[0].keys())
+    print("".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print(
+            f"{result['scenario']:>14}"
+            + "".join(f"{result[column]:>14.2f}" for column in columns[1:])
+        )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
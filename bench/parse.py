@@ -0,0 +1,94 @@
+"""CPU cost of parsing saved nettruyen pages.
+
+Save a few pages first (python -m bench.parse --save), then run
+python -m bench.parse to compare the full html.parser soup with the lxml
+soup restricted to what each extractor reads.
+"""
+import sys
+import time
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from chapter import CHAPTER_CENTER, _chapter
+from comic import ITEM_DETAIL, _comic
+from crawler import LISTING
+from helper import HTML_PARSER, helper
+from settings import CONFIG
+
+FIXTURES = Path(__file__).parent / "fixtures" / "pages"
+ROUNDS = 20
+
+
+def extract_listing(soup: BeautifulSoup):
+    div_items = soup.find("div", class_="items")
+    return div_items.find_all("div", class_="item") if div_items else []
+
+
+def extract_comic(soup: BeautifulSoup):
+    return _comic.get_comic_details(href="https://example.com/comic", soup=soup)
+
+
+def extract_chapter(soup: BeautifulSoup):
+    return _chapter.get_chapter_detail(chapter_name="", soup=soup)
+
+
+PAGE_KINDS = {
+    "listing": (LISTING, extract_listing),
+    "comic": (ITEM_DETAIL, extract_comic),
+    "chapter": (CHAPTER_CENTER, extract_chapter),
+}
+
+
+def save_pages():
+    listing_url = f"{CONFIG.NETTRUYEN_HOMEPAGE}/?page=1"
+    listing = helper.download_url(listing_url).content
+    save_page("listing", "1", listing)
+
+    items = extract_listing(BeautifulSoup(listing, "html.parser"))
+    for i, item in enumerate(items[:3]):
+        href = item.find("a").get("href")
+        comic = helper.download_url(href).content
+        save_page("comic", str(i), comic)
+
+        details = extract_comic(BeautifulSoup(comic, "html.parser"))
+        chapters = [chapter.href for chapter in details.get("chapters", [])]
+        if chapters:
+            save_page("chapter", str(i), helper.download_url(chapters[0]).content)
+
+
+def save_page(kind: str, name: str, content: bytes):
+    path = FIXTURES / kind
+    path.mkdir(parents=True, exist_ok=True)
+    (path / f"{name}.html").write_bytes(content)
+
+
+def measure(pages: list, parser: str, parse_only, extract) -> float:
+    start = time.process_time()
+    for _ in range(ROUNDS):
+        for content in pages:
+            extract(BeautifulSoup(content, parser, parse_only=parse_only))
+    return (time.process_time() - start) / (ROUNDS * len(pages)) * 1000
+
+
+def main():
+    if "--save" in sys.argv:
+        save_pages()
+
+    print(f"{'page':<10}{'pages':>6}{'html.parser':>14}{HTML_PARSER + '+strainer':>20}")
+    for kind, (strainer, extract) in PAGE_KINDS.items():
+        pages = [path.read_bytes() for path in sorted((FIXTURES / kind).glob("*.html"))]
+        if not pages:
+            print(f"{kind:<10}{'no saved pages':>20}")
+            continue
+
+        full = measure(pages, "html.parser", None, extract)
+        strained = measure(pages, HTML_PARSER, strainer, extract)
+        print(
+            f"{kind:<10}{len(pages):>6}{full:>12.2f}ms{strained:>18.2f}ms"
+            f"  x{full / strained:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
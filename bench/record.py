@@ -0,0 +1,134 @@
+"""Record nettruyen pages and images into bench/fixtures/site.
+
+python -m bench.record --pages 1 --comics 3 --chapters 3
+
+Comics and chapters that are not recorded are removed from the saved
+listing and comic pages, so replaying them never leaves the fixtures.
+"""
+import argparse
+import hashlib
+import json
+import logging
+
+from bs4 import BeautifulSoup
+
+from bench.stub import SITE, get_url_key
+from chapter import _chapter
+from comic import _comic
+from helper import helper
+from settings import CONFIG
+
+
+def save(index: dict, url: str, content: bytes, content_type: str, kind: str):
+    key = get_url_key(url)
+    file = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    (SITE / file).write_bytes(content)
+    index["pages"][key] = {"file": file, "content_type": content_type, "kind": kind}
+
+
+def record_url(index: dict, url: str, kind: str) -> bytes:
+    response = helper.download_url(url)
+    response.raise_for_status()
+    content_type = response.headers.get("content-type", "application/octet-stream")
+    save(index, url, response.content, content_type, kind)
+    return response.content
+
+
+def record_chapter(index: dict, comic_details: dict, chapter_name: str, href: str):
+    content = record_url(index, href, "chapter")
+    soup = BeautifulSoup(content, "html.parser")
+    chapter_details = _chapter.get_chapter_detail(chapter_name=chapter_name, soup=soup)
+    for image_details in chapter_details.values():
+        record_url(index, image_details["src"], "image")
+
+    index["chapters"].append(
+        {
+            "comic_title": comic_details["title"],
+            "comic_slug": comic_details["slug"],
+            "name": chapter_name,
+            "href": href,
+        }
+    )
+
+
+def record_comic(index: dict, href: str, chapters: int) -> bool:
+    response = helper.download_url(href)
+    soup = BeautifulSoup(response.content, "html.parser")
+    comic_details = _comic.get_comic_details(href=href, soup=soup)
+    if not comic_details:
+        return False
+
+    if comic_details.get("cover_url"):
+        record_url(index, comic_details["cover_url"], "image")
+
+    recorded = comic_details["chapters"][:chapters]
+    for chapter in recorded:
+        record_chapter(index, comic_details, chapter.name, chapter.href)
+    recorded_hrefs = {chapter.href for chapter in recorded}
+
+    nt_listchapter = soup.find("div", {"id": "nt_listchapter"})
+    for li in nt_listchapter.find_all("li") if nt_listchapter else []:
+        a = li.find("a")
+        if a and a.get("href") not in recorded_hrefs:
+            li.decompose()
+
+    save(index, href, str(soup).encode("utf-8"), "text/html", "comic")
+    index["comics"].append(href)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1)
+    parser.add_argument("--comics", type=int, default=3, help="per listing page")
+    parser.add_argument("--chapters", type=int, default=3, help="per comic")
+    args = parser.parse_args()
+
+    SITE.mkdir(parents=True, exist_ok=True)
+    index = {
+        "homepage": CONFIG.NETTRUYEN_HOMEPAGE,
+        "pages": {},
+        "listing": [],
+        "comics": [],
+        "chapters": [],
+    }
+
+    for page in range(1, args.pages + 1):
+        url = f"{CONFIG.NETTRUYEN_HOMEPAGE}/?page={page}"
+        soup = BeautifulSoup(helper.download_url(url).content, "html.parser")
+        div_items = soup.find("div", class_="items")
+        if not div_items:
+            logging.error(f"[-] No items on {url}")
+            continue
+
+        recorded = 0
+        for item in div_items.find_all("div", class_="item"):
+            a = item.find("a")
+            href = a.get("href") if a else ""
+            if recorded >= args.comics or not href:
+                item.decompose()
+                continue
+
+            try:
+                is_recorded = record_comic(index, href, args.chapters)
+            except Exception as e:
+                logging.error(f"[-] Failed to record {href}: {e}")
+                is_recorded = False
+
+            if is_recorded:
+                recorded += 1
+            else:
+                item.decompose()
+
+        save(index, url, str(soup).encode("utf-8"), "text/html", "listing")
+        index["listing"].append(url)
+
+    (SITE / "index.json").write_text(json.dumps(index, indent=4))
+    logging.info(
+        f"Recorded {len(index['comics'])} comics, {len(index['chapters'])} chapters, "
+        f"{len(index['pages'])} urls"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import json
+import random
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import sleep
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+from _db import Database
+from helper import HTTP_POOL_HOSTS, HTTP_POOL_SIZE, helper
+from settings import CONFIG
+
+SITE = Path(__file__).parent / "fixtures" / "site"
+
+# Auto increment key of every table Madara inserts into
+AUTO_IDS = {
+    "posts": "ID",
+    "postmeta": "meta_id",
+    "manga_chapters": "chapter_id",
+    "terms": "term_id",
+    "term_taxonomy": "term_taxonomy_id",
+}
+
+
+def get_url_key(url: str) -> str:
+    # host/path?query, the same for http and https
+    return url.split("://", 1)[-1]
+
+
+def load_index() -> dict:
+    return json.loads((SITE / "index.json").read_text())
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the crawler's connection pool behaves as in production
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        sleep(server.latency)
+
+        entry = server.index["pages"].get(self.path.lstrip("/"))
+        if random.random() < server.error_rate:
+            status, body, content_type = 503, b"", "text/plain"
+        elif not entry:
+            status, body, content_type = 404, b"", "text/plain"
+        else:
+            status = 200
+            body = (SITE / entry["file"]).read_bytes()
+            content_type = entry["content_type"]
+
+        server.count(entry["kind"] if entry else "missing", status, len(body))
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, index: dict, latency: float = 0, error_rate: float = 0):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.index = index
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = {}
+            self.errors = 0
+            self.bytes = 0
+
+    def count(self, kind: str, status: int, size: int):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.errors += status != 200
+            self.bytes += size
+
+    def start(self) -> "StubServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StubAdapter(HTTPAdapter):
+    # Sends every request of the crawler to the stub server instead
+    def __init__(self, stub_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.stub_url = stub_url
+
+    def send(self, request, **kwargs):
+        if not request.url.startswith(self.stub_url):
+            parts = urlsplit(request.url)
+            query = f"?{parts.query}" if parts.query else ""
+            request.url = f"{self.stub_url}/{parts.netloc}{parts.path}{query}"
+        return super().send(request, **kwargs)
+
+
+def install_stub(stub_url: str):
+    adapter = StubAdapter(
+        stub_url, pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE
+    )
+    helper.session.mount("http://", adapter)
+    helper.session.mount("https://", adapter)
+
+
+class ShimCursor:
+    def __init__(self, connection: "ShimConnection"):
+        self.connection = connection
+        self.cur = connection.sqlite.cursor()
+
+    def translate(self, query: str) -> str:
+        return query.replace("%s", "?").replace("INSERT IGNORE", "INSERT OR IGNORE")
+
+    def execute(self, query: str, params: tuple = ()):
+        self.connection.statements += 1
+        self.cur.execute(self.translate(query), tuple(params or ()))
+
+    def executemany(self, query: str, data: list):
+        # mysql-connector sends this as one multi-row INSERT
+        self.connection.statements += 1
+        self.cur.executemany(self.translate(query), data)
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    @property
+    def lastrowid(self):
+        return self.cur.lastrowid
+
+    def close(self):
+        self.cur.close()
+
+
+class ShimConnection:
+    def __init__(self, path: str = ":memory:"):
+        self.sqlite = sqlite3.connect(path, check_same_thread=False)
+        self.statements = 0
+        self.create_tables()
+
+    def create_tables(self):
+        for table, cols in CONFIG.INSERT.items():
+            columns = list(cols)
+            if table in AUTO_IDS:
+                columns.insert(0, f"{AUTO_IDS[table]} INTEGER PRIMARY KEY")
+            if table == "term_relationships":
+                columns.append(f"UNIQUE ({cols[0]}, {cols[1]})")
+            self.sqlite.execute(
+                f"CREATE TABLE IF NOT EXISTS {CONFIG.TABLE_PREFIX}{table} "
+                f"({', '.join(columns)})"
+            )
+        self.sqlite.commit()
+
+    def cursor(self, prepared: bool = False) -> ShimCursor:
+        return ShimCursor(self)
+
+    def start_transaction(self):
+        pass
+
+    def commit(self):
+        self.sqlite.commit()
+
+    def rollback(self):
+        self.sqlite.rollback()
+
+    def ping(self, **kwargs):
+        pass
+
+    def reconnect(self, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteDatabase(Database):
+    # Stand-in for MariaDB with the tables Madara writes to, counting statements
+    def __init__(self, path: str = ":memory:") -> None:
+        super().__init__()
+        self.connection = ShimConnection(path)
+
+    def get_conn(self):
+        return self.connection
+
+    @property
+    def statements(self) -> int:
+        return self.connection.statements
+
+    def count(self, table: str) -> int:
+        return self.connection.sqlite.execute(
+            f"SELECT COUNT(*) FROM {CONFIG.TABLE_PREFIX}{table}"
+        ).fetchone()[0]
@@ -0,0 +1,393 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+from slugify import slugify
+
+from _db import Database, get_chunks, get_in
+from chapter import ChapterRecord
+from madara import Madara
+from settings import CONFIG
+
+logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=logging.INFO)
+
+BULK_STAGE_PATH = getattr(CONFIG, "BULK_STAGE_PATH", "data/stage")
+# Rows per multi-row INSERT and per transaction. Chapter contents are large,
+# a batch must stay below max_allowed_packet
+BULK_BATCH_SIZE = getattr(CONFIG, "BULK_BATCH_SIZE", 200)
+
+
+def iter_jsonl(path: str):
+    # One record at a time, the chapters file holds every chapter's content
+    if not os.path.isfile(path):
+        return
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # The last line of a crawler that was killed mid-write
+                logging.warning(f"[-] Skipped a broken line of {path}")
+
+
+def iter_batches(records):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == BULK_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_thumb_name(record: dict) -> str:
+    return slugify(record["saved_thumb_url"].split("/")[-1])
+
+
+class Stage:
+    def __init__(self, path: str = BULK_STAGE_PATH) -> None:
+        self.comics_path = os.path.join(path, "comics.jsonl")
+        self.chapters_path = os.path.join(path, "chapters.jsonl")
+        self.lock_path = os.path.join(path, ".lock")
+        Path(path).mkdir(parents=True, exist_ok=True)
+        # Guards comics / chapters, file_lock guards the files themselves
+        self.lock = threading.Lock()
+        self.comics = None
+        # comic ref (id or slug) -> staged chapter slugs
+        self.chapters = None
+
+    def load(self) -> None:
+        # What is staged but not loaded yet, so a restarted crawl skips it
+        self.comics, self.chapters = set(), {}
+        for path in [self.comics_path, f"{self.comics_path}.loading"]:
+            self.comics.update(record["slug"] for record in iter_jsonl(path))
+        for path in [self.chapters_path, f"{self.chapters_path}.loading"]:
+            for record in iter_jsonl(path):
+                self.chapters.setdefault(str(record["comic"]), set()).add(
+                    record["chapter"]["slug"]
+                )
+
+    @contextmanager
+    def file_lock(self):
+        # crawl_all.py --stage and bulk_import.py run in separate processes
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def append(self, path: str, record: dict) -> None:
+        # Opened on every write, so the loader can rename the file away
+        with self.file_lock(), open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def is_comic_staged(self, slug: str) -> bool:
+        with self.lock:
+            if self.comics is None:
+                self.load()
+            return slug in self.comics
+
+    def put_comic(self, comic_data: dict, saved_thumb_url: str, thumb_save_path: str):
+        with self.lock:
+            if self.comics is None:
+                self.load()
+            self.append(
+                self.comics_path,
+                {
+                    "slug": comic_data["slug"],
+                    # The chapters are staged one by one once they are crawled
+                    "comic_data": {
+                        key: value
+                        for key, value in comic_data.items()
+                        if key != "chapters"
+                    },
+                    "saved_thumb_url": saved_thumb_url,
+                    "thumb_save_path": thumb_save_path,
+                },
+            )
+            self.comics.add(comic_data["slug"])
+
+    def get_chapter_slugs(self, comic_ref) -> set:
+        with self.lock:
+            if self.chapters is None:
+                self.load()
+            return set(self.chapters.get(str(comic_ref), ()))
+
+    def put_chapter(self, comic_ref, chapter: ChapterRecord, content: str) -> None:
+        with self.lock:
+            if self.chapters is None:
+                self.load()
+            self.append(
+                self.chapters_path,
+                {"comic": comic_ref, "chapter": chapter.to_dict(), "content": content},
+            )
+            self.chapters.setdefault(str(comic_ref), set()).add(chapter.slug)
+
+
+_stage = Stage()
+
+
+class StagingMadara(Madara):
+    # Crawls as usual but stages new comics and chapters for BulkLoader. A
+    # comic that is only staged is referenced by its slug instead of its id.
+    def get_or_insert_comic(self, comic_details: dict, thumb: tuple = None):
+        be_post = self.database.select_all_from(
+            table="posts",
+            condition="post_name = %s",
+            cols="ID",
+            params=(comic_details["slug"],),
+            prepared=True,
+        )
+        if be_post:
+            return be_post[0][0]
+
+        if not _stage.is_comic_staged(comic_details["slug"]):
+            saved_thumb_url, thumb_save_path = thumb or self.get_thumb(comic_details)
+            _stage.put_comic(comic_details, saved_thumb_url, thumb_save_path)
+        return comic_details["slug"]
+
+    def get_backend_chapters_slug(self, comic_id, chapter_slugs: list = ()) -> set:
+        staged = _stage.get_chapter_slugs(comic_id)
+        if isinstance(comic_id, str):
+            return staged
+        return super().get_backend_chapters_slug(comic_id, chapter_slugs) | staged
+
+    def insert_chapter(self, comic_id, chapter: ChapterRecord, content: str) -> bool:
+        _stage.put_chapter(comic_id, chapter, content)
+        return True
+
+
+class BulkLoader:
+    def __init__(self, database: Database, stage: Stage = _stage) -> None:
+        self.database = database
+        self.stage = stage
+        self._madara = Madara(database=database)
+
+    def select_in(
+        self,
+        table: str,
+        cols: str,
+        column: str,
+        values: list,
+        condition: str = "1=1",
+        params: tuple = (),
+    ) -> list:
+        rows = []
+        for chunk in get_chunks(list(values), BULK_BATCH_SIZE):
+            rows += self.database.select_all_from(
+                table=table,
+                condition=f"{condition} AND {get_in(column, chunk)}",
+                cols=cols,
+                params=(*params, *chunk),
+            )
+        return rows
+
+    def get_post_ids(self, post_type: str, post_names: list) -> dict:
+        # post_name -> newest ID, multi-row INSERTs only return the first id
+        # so new rows are read back by name inside the same transaction
+        post_ids = {}
+        for post_name, post_id in self.select_in(
+            table="posts",
+            cols="post_name, ID",
+            column="post_name",
+            values=post_names,
+            condition="post_type = %s",
+            params=(post_type,),
+        ):
+            post_ids[post_name] = max(post_id, post_ids.get(post_name, 0))
+        return post_ids
+
+    def insert_thumbs(self, records: list) -> dict:
+        # comic slug -> attachment ID, one attachment per comic like
+        # Madara.insert_thumb even when covers share a file (DEFAULT_THUMB).
+        # Only a name used once can be read back by name after a bulk INSERT
+        records = [record for record in records if record["saved_thumb_url"]]
+        names = Counter(get_thumb_name(record) for record in records)
+        unique = [record for record in records if names[get_thumb_name(record)] == 1]
+        self.database.insert_into(
+            table="posts",
+            data=[
+                self._madara.get_thumb_post_data(record["saved_thumb_url"])
+                for record in unique
+            ],
+            is_bulk=True,
+        )
+        name_ids = self.get_post_ids(
+            "attachment", [get_thumb_name(record) for record in unique]
+        )
+
+        thumb_ids = {}
+        for record in records:
+            if names[get_thumb_name(record)] == 1:
+                thumb_ids[record["slug"]] = name_ids[get_thumb_name(record)]
+            else:
+                thumb_ids[record["slug"]] = self.database.insert_into(
+                    table="posts",
+                    data=self._madara.get_thumb_post_data(record["saved_thumb_url"]),
+                )
+        return thumb_ids
+
+    def insert_comics(self, records: list) -> dict:
+        thumb_ids = self.insert_thumbs(records)
+
+        self.database.insert_into(
+            table="posts",
+            data=[
+                self._madara.get_comic_post_data(record["comic_data"])
+                for record in records
+            ],
+            is_bulk=True,
+        )
+        comic_ids = self.get_post_ids(
+            "wp-manga", [record["slug"] for record in records]
+        )
+
+        postmeta_data, term_relationships = [], []
+        for record in records:
+            comic_id = comic_ids[record["slug"]]
+            thumb_id = thumb_ids.get(record["slug"], 0)
+            if thumb_id:
+                postmeta_data += self._madara.get_thumb_postmeta(
+                    thumb_id, record["saved_thumb_url"], record["thumb_save_path"]
+                )
+            postmeta_data += self._madara.get_comic_postmeta(
+                comic_id, thumb_id, record["comic_data"]
+            )
+            # New terms are still inserted one by one, most are cached
+            term_relationships += self._madara.get_comic_term_relationships(
+                comic_id, record["comic_data"]
+            )
+
+        for chunk in get_chunks(postmeta_data, BULK_BATCH_SIZE):
+            self._madara.insert_postmeta(chunk)
+        for chunk in get_chunks(term_relationships, BULK_BATCH_SIZE):
+            self.database.insert_into(
+                table="term_relationships", data=chunk, is_bulk=True, ignore=True
+            )
+
+        return comic_ids
+
+    def load_comics(self, records) -> dict:
+        # The last staged version of a comic wins. Comic records are small,
+        # they carry no chapters
+        records = {record["slug"]: record for record in records}
+        comic_ids = self.get_post_ids("wp-manga", list(records))
+        new_records = [
+            record for slug, record in records.items() if slug not in comic_ids
+        ]
+
+        for batch in get_chunks(new_records, BULK_BATCH_SIZE):
+            with self._madara.terms_transaction():
+                comic_ids.update(self.insert_comics(batch))
+            logging.info(f"[+] Loaded {len(batch)} comics")
+
+        return comic_ids
+
+    def get_chapter_ids(self, comic_ids: list) -> dict:
+        # (comic_id, chapter_slug) -> chapter_id
+        return {
+            (comic_id, chapter_slug): chapter_id
+            for comic_id, chapter_slug, chapter_id in self.select_in(
+                table="manga_chapters",
+                cols="post_id, chapter_slug, chapter_id",
+                column="post_id",
+                values=comic_ids,
+            )
+        }
+
+    def insert_chapters(self, records: list) -> None:
+        comic_ids = list({record["comic_id"] for record in records})
+        self.database.insert_into(
+            table="manga_chapters",
+            data=[
+                self._madara.get_chapter_data(record["comic_id"], record["chapter"])
+                for record in records
+            ],
+            is_bulk=True,
+        )
+        chapter_ids = self.get_chapter_ids(comic_ids)
+
+        self.database.insert_into(
+            table="posts",
+            data=[
+                self._madara.get_chapter_post_data(
+                    chapter_ids[(record["comic_id"], record["chapter"].slug)],
+                    record["chapter"],
+                    record["content"],
+                )
+                for record in records
+            ],
+            is_bulk=True,
+        )
+
+    def load_chapters(self, records: list, comic_ids: dict) -> list:
+        # Loads one batch, returns the records whose comic is not in the
+        # database. Comics staged by an earlier load are only known by slug
+        missing_slugs = {
+            record["comic"]
+            for record in records
+            if isinstance(record["comic"], str) and record["comic"] not in comic_ids
+        }
+        if missing_slugs:
+            comic_ids.update(self.get_post_ids("wp-manga", list(missing_slugs)))
+
+        chapters, unresolved = {}, []
+        for record in records:
+            comic_id = record["comic"]
+            if isinstance(comic_id, str):
+                comic_id = comic_ids.get(comic_id)
+            if not comic_id:
+                logging.error(f"[-] Comic {record['comic']} was not loaded")
+                unresolved.append(record)
+                continue
+
+            record["comic_id"] = comic_id
+            record["chapter"] = ChapterRecord(**record["chapter"])
+            chapters[(comic_id, record["chapter"].slug)] = record
+
+        # A chapter staged twice is loaded from its first batch
+        existing = self.get_chapter_ids(list({key[0] for key in chapters}))
+        new_records = [
+            record for key, record in chapters.items() if key not in existing
+        ]
+
+        if new_records:
+            with self.database.transaction():
+                self.insert_chapters(new_records)
+            logging.info(f"[+] Loaded {len(new_records)} chapters")
+
+        return unresolved
+
+    def load(self) -> None:
+        # Files being written by the crawler are renamed away first, a
+        # .loading file left by a failed load is loaded again
+        with self.stage.file_lock():
+            for path in [self.stage.comics_path, self.stage.chapters_path]:
+                if os.path.isfile(path) and not os.path.isfile(f"{path}.loading"):
+                    os.replace(path, f"{path}.loading")
+
+        comic_ids = self.load_comics(iter_jsonl(f"{self.stage.comics_path}.loading"))
+        unresolved = []
+        for batch in iter_batches(iter_jsonl(f"{self.stage.chapters_path}.loading")):
+            unresolved += self.load_chapters(batch, comic_ids)
+
+        # Staged again, the fingerprints already count these chapters as done
+        for record in unresolved:
+            self.stage.append(self.stage.chapters_path, record)
+
+        for path in [self.stage.comics_path, self.stage.chapters_path]:
+            if os.path.isfile(f"{path}.loading"):
+                os.remove(f"{path}.loading")
+
+
+def main():
+    BulkLoader(database=Database()).load()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,77 @@
-from bs4 import BeautifulSoup
+import re
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+import pytz
+from bs4 import BeautifulSoup, SoupStrainer
 from slugify import slugify
 
+from profiler import _profiler
+
+# The only part of a chapter page get_chapter_detail reads
+CHAPTER_CENTER = SoupStrainer("div", {"id": "ctl00_divCenter"})
+
+# "Chapter 12.5", "Chap 7", "Chương 3,5" or just "12"
+CHAPTER_NUMBER = re.compile(r"(?:chapter|chap|chương)\s*(\d+)(?:[.,](\d+))?", re.I)
+NUMBER = re.compile(r"\s*(\d+)(?:[.,](\d+))?\s*")
+
+vn_timezone = pytz.timezone("Asia/Ho_Chi_Minh")
+
+
+def get_timeupdate(seconds_ago: int = 0) -> str:
+    timeupdate = datetime.now(vn_timezone) - timedelta(seconds=seconds_ago)
+    return timeupdate.strftime("%Y/%m/%d %H:%M:%S")
+
+
+@dataclass(slots=True)
+class ChapterRecord:
+    # Computed once when the comic page is parsed, then passed down to Madara
+    name: str
+    href: str
+    slug: str
+    # Reading order: (chapter, sub-chapter, extras after it)
+    index: tuple
+    # post_date / post_modified of the rows inserted for the chapter
+    timeupdate: str
+
+    def __post_init__(self) -> None:
+        # A list once it went through JSON
+        self.index = tuple(self.index)
+
+    def to_dict(self) -> dict:
+        # For the JSON of the job queue and the bulk import stage
+        return asdict(self)
+
 
 class Chapter:
     def get_chapter_slug(self, chapter_name: str) -> str:
         return slugify(chapter_name)
 
+    def get_chapter_number(self, chapter_name: str) -> Optional[tuple]:
+        # (12, 5) for "Chapter 12.5", integers so that 1.10 comes after 1.9.
+        # None for extras, specials... that carry no chapter number
+        match = CHAPTER_NUMBER.search(chapter_name) or NUMBER.fullmatch(chapter_name)
+        if not match:
+            return None
+        return (int(match.group(1)), int(match.group(2) or 0))
+
+    def get_image_order(self, image_number: str) -> tuple:
+        # data-index is the reading order, images without one keep page order
+        return (0, int(image_number)) if image_number.isdigit() else (1, 0)
+
+    def get_chapter_record(
+        self, chapter_name: str, href: str, index: tuple = (), timeupdate: str = ""
+    ) -> ChapterRecord:
+        return ChapterRecord(
+            name=chapter_name,
+            href=href,
+            slug=self.get_chapter_slug(chapter_name=chapter_name),
+            index=index,
+            timeupdate=timeupdate or get_timeupdate(),
+        )
+
+    @_profiler.span
     def get_chapter_detail(self, chapter_name: str, soup: BeautifulSoup) -> dict:
         result = {}
 
@@ -34,7 +100,7 @@ class Chapter:
                 "src": img_src,
             }
 
-        return result
+        return dict(sorted(result.items(), key=lambda x: self.get_image_order(x[0])))
 
 
 _chapter = Chapter()
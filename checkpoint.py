@@ -0,0 +1,43 @@
+from settings import CONFIG
+from sqlite_store import SqliteStore
+
+CHECKPOINT_DB = getattr(CONFIG, "CHECKPOINT_DB", "data/crawl_all.sqlite3")
+
+
+class Checkpoint(SqliteStore):
+    def __init__(self, path: str = CHECKPOINT_DB) -> None:
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS pages (page INTEGER PRIMARY KEY)",
+            "CREATE TABLE IF NOT EXISTS comics (slug TEXT PRIMARY KEY)",
+        )
+
+    def is_done(self, table: str, key) -> bool:
+        column = "page" if table == "pages" else "slug"
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT 1 FROM {table} WHERE {column} = ?", (key,)
+            ).fetchone()
+
+        return row is not None
+
+    def mark_done(self, table: str, key) -> None:
+        self.write(f"INSERT OR IGNORE INTO {table} VALUES (?)", (key,))
+
+    def is_page_done(self, page: int) -> bool:
+        return self.is_done("pages", page)
+
+    def mark_page_done(self, page: int) -> None:
+        self.mark_done("pages", page)
+
+    def is_comic_done(self, slug: str) -> bool:
+        return self.is_done("comics", slug)
+
+    def mark_comic_done(self, slug: str) -> None:
+        self.mark_done("comics", slug)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM pages")
+            self.conn.execute("DELETE FROM comics")
+            self.conn.commit()
@@ -1,6 +1,12 @@
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from slugify import slugify
 
+from chapter import _chapter, get_timeupdate
+from profiler import _profiler
+
+# The only part of a comic page get_comic_details reads
+ITEM_DETAIL = SoupStrainer("article", {"id": "item-detail"})
+
 
 class Comic:
     def get_title(self, item_detail: BeautifulSoup) -> str:
@@ -48,10 +54,10 @@ class Comic:
 
         return p.text
 
-    def get_chapters_href(self, item_detail: BeautifulSoup) -> dict:
+    def get_chapters_href(self, item_detail: BeautifulSoup) -> list:
         nt_listchapter = item_detail.find("div", {"id": "nt_listchapter"})
         if not nt_listchapter:
-            return {}
+            return []
 
         chapters_dict = {}
         li_elements = nt_listchapter.find_all("li")
@@ -69,20 +75,46 @@ class Comic:
             if href:
                 chapters_dict[chapter_name] = href
 
-        return chapters_dict
-
+        # Indexed by chapter number, oldest first so that an extra or a special
+        # without a number follows the chapter listed before it
+        indexed, index = [], (0, 0, 0)
+        for chapter_name, href in reversed(chapters_dict.items()):
+            number = _chapter.get_chapter_number(chapter_name=chapter_name)
+            index = (*number, 0) if number is not None else (*index[:2], index[2] + 1)
+            indexed.append((index, chapter_name, href))
+
+        # Ties keep the order of the page. One second apart in reading order,
+        # so the dates Madara sorts chapters by follow the chapter numbers
+        indexed.sort(key=lambda item: item[0])
+        chapters = [
+            _chapter.get_chapter_record(
+                chapter_name=chapter_name,
+                href=href,
+                index=index,
+                timeupdate=get_timeupdate(seconds_ago=len(indexed) - 1 - rank),
+            )
+            for rank, (index, chapter_name, href) in enumerate(indexed)
+        ]
+
+        # Newest first like the page
+        return chapters[::-1]
+
+    def get_comic_slug(self, href: str) -> str:
+        return href.strip().strip("/").split("/")[-1]
+
+    @_profiler.span
     def get_comic_details(self, href: str, soup: BeautifulSoup) -> dict:
         item_detail = soup.find("article", {"id": "item-detail"})
         if not item_detail:
             return {}
 
         title = self.get_title(item_detail=item_detail)
-        slug = href.strip().strip("/").split("/")[-1]
+        slug = self.get_comic_slug(href=href)
         cover_url = self.get_cover_url(item_detail=item_detail)
         description = self.get_description(item_detail=item_detail)
         detail_list_info = self.get_list_info(item_detail=item_detail)
 
-        chapters_dict = self.get_chapters_href(item_detail=item_detail)
+        chapters = self.get_chapters_href(item_detail=item_detail)
 
         return {
             "title": title,
@@ -90,7 +122,7 @@ class Comic:
             "cover_url": cover_url,
             "description": description,
             **detail_list_info,
-            "chapters": chapters_dict,
+            "chapters": chapters,
         }
 
 
@@ -1,18 +1,70 @@
+import logging
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
 from icecream import ic
 
 from _db import Database
+from async_crawler import AsyncCrawler
+from bulk_import import StagingMadara
+from checkpoint import Checkpoint
 from crawler import Crawler
+from job_queue import PRIORITY_BACKFILL, JobQueue
+from metrics import METRICS_PORT, _metrics
+from profiler import _profiler
 from settings import CONFIG
 from telegram_noti import send_direct_message
 
+# One pooled Database for the whole process, it reconnects by itself when
+# MariaDB drops the connection between passes
+database_for_crawl_all = Database()
+
+# Pages and comics finished in this pass, so a restart continues from there
+checkpoint = Checkpoint()
+
+CRAWL_ALL_WORKERS = getattr(CONFIG, "CRAWL_ALL_WORKERS", 4)
+# Long-lived threads keep their pooled database connection between passes
+page_executor = ThreadPoolExecutor(
+    max_workers=CRAWL_ALL_WORKERS, thread_name_prefix="page"
+)
+page_crawlers = threading.local()
+
+
+def get_madara() -> StagingMadara:
+    # --stage writes new comics and chapters to files for bulk_import.py
+    if "--stage" in sys.argv:
+        return StagingMadara(database=database_for_crawl_all)
+    return None
+
+
+def crawl_page(page: int) -> None:
+    if getattr(page_crawlers, "crawler", None) is None:
+        page_crawlers.crawler = Crawler(
+            database=database_for_crawl_all, checkpoint=checkpoint, madara=get_madara()
+        )
+
+    try:
+        with _profiler.profile_thread():
+            page_crawlers.crawler.crawl_page(page=page)
+        checkpoint.mark_page_done(page)
+    except Exception as e:
+        ic(page, e)
+        _metrics.inc("crawler_page_errors_total")
+
 
 def main():
-    database_for_crawl_all = Database()
+    since = _metrics.snapshot()
     print(f"Using database: {database_for_crawl_all} for crawl_all.py file...")
-    _crawler = Crawler(database=database_for_crawl_all)
+    if "--async" in sys.argv:
+        _crawler = AsyncCrawler(
+            database=database_for_crawl_all, checkpoint=checkpoint, madara=get_madara()
+        )
+    else:
+        _crawler = Crawler(
+            database=database_for_crawl_all, checkpoint=checkpoint, madara=get_madara()
+        )
 
     try:
         is_netttruyen_domain_work = _crawler.is_nettruyen_domain_work()
@@ -23,15 +75,47 @@ def main():
         last_page = _crawler.get_nettruyen_last_page()
         ic(last_page)
 
-        for i in range(2, last_page + 1):
-            _crawler.crawl_page(page=i)
-            sleep(CONFIG.WAIT_BETWEEN_ALL)
+        if "--queue" in sys.argv:
+            # queue_worker.py does the crawling, a new pass is only queued
+            # once the previous one has left the queue
+            job_queue = JobQueue()
+            if not job_queue.is_busy("page"):
+                for page in range(2, last_page + 1):
+                    job_queue.put_page(page, PRIORITY_BACKFILL)
+            ic(job_queue.count())
+            return
+
+        # One query for every comic instead of one per comic during the pass
+        _crawler._madara.load_chapters_slug_cache()
+
+        pages = [
+            page
+            for page in range(2, last_page + 1)
+            if not checkpoint.is_page_done(page)
+        ]
+        ic(len(pages))
+
+        if "--async" in sys.argv:
+            _crawler.run(pages=pages)
+        else:
+            list(page_executor.map(crawl_page, pages))
+
+        # Whole pass is done, the next one starts again from page 2
+        checkpoint.clear()
 
     except Exception as e:
         ic(e)
+        _metrics.inc("crawler_pass_errors_total", script="crawl_all")
+
+    logging.info(f"[+] Pass summary:\n{_metrics.get_summary(since)}")
 
 
 if __name__ == "__main__":
+    # Next to update.py's endpoint when both run on the same host
+    _metrics.serve(METRICS_PORT + 1 if METRICS_PORT else 0)
+    if "--profile" in sys.argv:
+        _profiler.enable()
     while True:
-        main()
+        with _profiler.profile_pass("crawl_all"):
+            main()
         sleep(CONFIG.WAIT_BETWEEN_LATEST)
@@ -5,6 +5,7 @@ from icecream import ic
 
 from _db import Database
 from crawler import Crawler
+from profiler import _profiler
 from settings import CONFIG
 from telegram_noti import send_direct_message
 
@@ -33,4 +34,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if "--profile" in sys.argv:
+        _profiler.enable()
+    with _profiler.profile_pass("crawl_links"):
+        main()
@@ -5,54 +5,130 @@ import sys
 from pathlib import Path
 from time import sleep
 
-import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from slugify import slugify
 
-from chapter import _chapter
-from comic import _comic
+from chapter import CHAPTER_CENTER, ChapterRecord, _chapter
+from checkpoint import Checkpoint
+from comic import ITEM_DETAIL, _comic
+from fingerprint import _fingerprint
 from helper import helper
 from madara import Madara
+from profiler import _profiler
+from rate_limiter import _rate_limiter
 from settings import CONFIG
 
 logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=logging.INFO)
 
+# Attempts before the homepage is reported as down and the domain as changed
+DOMAIN_CHECK_ATTEMPTS = getattr(CONFIG, "DOMAIN_CHECK_ATTEMPTS", 5)
+
+# Comic list and pagination of a listing page
+LISTING = SoupStrainer(class_=["items", "pagination"])
 
-class Crawler:
-    def __init__(self, database) -> None:
-        self._madara = Madara(database=database)
 
+class Crawler:
+    def __init__(
+        self,
+        database,
+        checkpoint: Checkpoint = None,
+        madara: Madara = None,
+        newest_first: bool = False,
+    ) -> None:
+        # bulk_import.StagingMadara writes to files instead of the database
+        self._madara = madara or Madara(database=database)
+        # Comics finished earlier in an interrupted crawl_all.py pass
+        self.checkpoint = checkpoint
+        # update.py lands the latest chapter first, a backfill goes in order
+        self.newest_first = newest_first
+
+    @_profiler.span
     def crawl_chapter(
         self,
         comic_title: int,
         comic_id: int,
         comic_slug: str,
-        chapter_name: str,
-        chapter_href: str,
-    ) -> None:
-        soup = helper.crawl_soup(chapter_href)
+        chapter: ChapterRecord,
+    ) -> bool:
+        soup = helper.crawl_soup(
+            chapter.href, parse_only=CHAPTER_CENTER, page_type="chapter"
+        )
 
         chapter_details = _chapter.get_chapter_detail(
-            chapter_name=chapter_name, soup=soup
+            chapter_name=chapter.name, soup=soup
         )
 
         # with open("json/chapter.json", "w") as f:
         #     f.write(json.dumps(chapter_details, indent=4, ensure_ascii=False))
 
-        content = self._madara.get_download_chapter_content(
+        content, failed_images = self._madara.get_download_chapter_content(
             comic_title=comic_title,
             comic_slug=comic_slug,
             chapter_details=chapter_details,
-            chapter_name=chapter_name,
+            chapter=chapter,
         )
-        self._madara.insert_chapter(
-            comic_id=comic_id, chapter_name=chapter_name, content=content
+        if failed_images:
+            # Leave the chapter out of the database so the next pass retries it
+            helper.error_log(
+                msg=f"Failed images for {chapter.href}\n" + "\n".join(failed_images),
+                filename="crawler.crawl_chapter.log",
+            )
+            logging.error(
+                f"[-] {len(failed_images)} images failed, skipped {chapter.name}"
+            )
+            return False
+
+        if not self._madara.insert_chapter(
+            comic_id=comic_id, chapter=chapter, content=content
+        ):
+            return False
+
+        logging.info(f"Inserted {chapter.name}")
+        return True
+
+    def get_chapters_fingerprint(self, chapters: list) -> str:
+        return _fingerprint.get_hash(
+            [f"{chapter.name}|{chapter.href}" for chapter in chapters]
         )
-        logging.info(f"Inserted {chapter_name}")
 
-    def crawl_comic(self, href: str):
-        soup = helper.crawl_soup(href)
+    def get_missing_chapters(
+        self, chapters: list, inserted_chapters_slug: set, newest_first: bool = None
+    ) -> list:
+        # chapters come newest first from Comic.get_chapters_href
+        if newest_first is None:
+            newest_first = self.newest_first
+        missing_chapters = [
+            chapter
+            for chapter in chapters
+            if chapter.slug not in inserted_chapters_slug
+        ]
+        return missing_chapters if newest_first else missing_chapters[::-1]
+
+    @_profiler.span
+    def crawl_comic(
+        self,
+        href: str,
+        listing_fingerprint: str = "",
+        crawl_chapter=None,
+        newest_first: bool = None,
+    ) -> bool:
+        # crawl_chapter lets the job queue take the missing chapters instead
+        crawl_chapter = crawl_chapter or self.crawl_chapter
+
+        soup = helper.crawl_soup(href, parse_only=ITEM_DETAIL, page_type="comic")
         comic_details = _comic.get_comic_details(href=href, soup=soup)
+        if not comic_details:
+            logging.error(f"Cannot crawl comic with: {href}")
+            return False
+
+        # Same chapter list as the last complete crawl, nothing to diff
+        comic_slug = _comic.get_comic_slug(href=href)
+        chapters_fingerprint = self.get_chapters_fingerprint(
+            comic_details.get("chapters", [])
+        )
+        if _fingerprint.get(comic_slug)[1] == chapters_fingerprint:
+            _fingerprint.set(comic_slug, listing_fingerprint, chapters_fingerprint)
+            return True
 
         comic_id = self._madara.get_or_insert_comic(comic_details)
         logging.info(f"Got (or inserted) comic: {comic_id}")
@@ -62,28 +138,31 @@ class Crawler:
 
         if not comic_id:
             logging.error(f"Cannot crawl comic with: {href}")
-            return
+            return False
 
-        chapters = comic_details.get("chapters", {})
-        chapters_name = list(chapters.keys())
-        inserted_chapters_slug = self._madara.get_backend_chapters_slug(comic_id)
+        chapters = comic_details.get("chapters", [])
+        inserted_chapters_slug = self._madara.get_backend_chapters_slug(
+            comic_id, [chapter.slug for chapter in chapters]
+        )
         # inserted_chapters_slug = []  # self._madara.get_backend_chapters_slug(comic_id)
 
-        for chapter_name in chapters_name[::-1]:
-            chapter_slug = _chapter.get_chapter_slug(chapter_name=chapter_name)
-            if chapter_slug in inserted_chapters_slug:
-                continue
-
-            chapter_href = chapters.get(chapter_name)
-            self.crawl_chapter(
+        is_completed = True
+        for chapter in self.get_missing_chapters(
+            chapters, inserted_chapters_slug, newest_first
+        ):
+            is_completed &= crawl_chapter(
                 comic_title=comic_details.get("title"),
                 comic_id=comic_id,
                 comic_slug=comic_details.get("slug"),
-                chapter_name=chapter_name,
-                chapter_href=chapter_href,
+                chapter=chapter,
             )
 
-    def crawl_item(self, item: BeautifulSoup):
+        if is_completed:
+            _fingerprint.set(comic_slug, listing_fingerprint, chapters_fingerprint)
+
+        return is_completed
+
+    def get_item_href(self, item: BeautifulSoup) -> str:
         image = item.find("div", class_="image")
         figcaption = item.find("figcaption")
 
@@ -98,15 +177,59 @@ class Crawler:
             if a:
                 href = a.get("href")
 
+        return href
+
+    def get_item_fingerprint(self, item: BeautifulSoup) -> str:
+        # Latest chapters shown under the item, without the relative time
+        chapters = [
+            f"{a.text.strip()}|{a.get('href')}"
+            for li in item.find_all("li", class_="chapter")
+            for a in li.find_all("a")
+        ]
+        if not chapters:
+            return ""
+
+        return _fingerprint.get_hash(chapters)
+
+    def is_item_unchanged(self, href: str, listing_fingerprint: str) -> bool:
+        if not listing_fingerprint:
+            return False
+
+        comic_slug = _comic.get_comic_slug(href=href)
+        return _fingerprint.get(comic_slug)[0] == listing_fingerprint
+
+    def is_comic_done(self, href: str) -> bool:
+        if not self.checkpoint:
+            return False
+
+        return self.checkpoint.is_comic_done(_comic.get_comic_slug(href=href))
+
+    def mark_comic_done(self, href: str) -> None:
+        if self.checkpoint:
+            self.checkpoint.mark_comic_done(_comic.get_comic_slug(href=href))
+
+    def crawl_item(self, item: BeautifulSoup, crawl_comic=None):
+        crawl_comic = crawl_comic or self.crawl_comic
+
+        href = self.get_item_href(item=item)
         if not href:
             logging.error("[-] Could not find href for item")
             return
 
-        self.crawl_comic(href=href)
+        listing_fingerprint = self.get_item_fingerprint(item=item)
+        if self.is_comic_done(href) or self.is_item_unchanged(
+            href, listing_fingerprint
+        ):
+            logging.info(f"[=] Unchanged {href}")
+            return
+
+        if crawl_comic(href=href, listing_fingerprint=listing_fingerprint):
+            self.mark_comic_done(href)
 
-    def crawl_page(self, page: int = 1):
+    @_profiler.span
+    def crawl_page(self, page: int = 1, crawl_comic=None):
         url = f"{CONFIG.NETTRUYEN_HOMEPAGE}/?page={page}"
-        soup = helper.crawl_soup(url)
+        soup = helper.crawl_soup(url, parse_only=LISTING, page_type="listing")
 
         div_items = soup.find("div", class_="items")
         if not div_items:
@@ -115,13 +238,13 @@ class Crawler:
         items = div_items.find_all("div", class_="item")
 
         for item in items:
-            self.crawl_item(item=item)
+            self.crawl_item(item=item, crawl_comic=crawl_comic)
 
         return 1
 
     def get_nettruyen_last_page(self):
         url = f"{CONFIG.NETTRUYEN_HOMEPAGE}/?page=1"
-        soup = helper.crawl_soup(url)
+        soup = helper.crawl_soup(url, parse_only=LISTING, page_type="listing")
 
         try:
             pagination = soup.find("ul", class_="pagination")
@@ -137,15 +260,16 @@ class Crawler:
             return CONFIG.NETTRUYEN_LAST_PAGE
 
     def is_nettruyen_domain_work(self):
-        for _ in range(5):
+        # download_url already waits out 429 / 503 for the homepage's host
+        for _ in range(DOMAIN_CHECK_ATTEMPTS):
             try:
                 response = helper.download_url(CONFIG.NETTRUYEN_HOMEPAGE)
                 if response.status_code == 200:
                     return True
-
             except Exception as e:
-                pass
+                logging.warning(f"[-] Homepage check failed: {e}")
 
-            sleep(5)
+            # Every failure lowered the host's rate, so the gap keeps growing
+            sleep(_rate_limiter.get_interval(CONFIG.NETTRUYEN_HOMEPAGE))
 
         return False
@@ -0,0 +1,43 @@
+import hashlib
+
+from settings import CONFIG
+from sqlite_store import SqliteStore
+
+FINGERPRINT_DB = getattr(CONFIG, "FINGERPRINT_DB", "data/fingerprints.sqlite3")
+
+
+class Fingerprint(SqliteStore):
+    def __init__(self, path: str = FINGERPRINT_DB) -> None:
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS fingerprints "
+            "(slug TEXT PRIMARY KEY, listing TEXT, chapters TEXT)",
+        )
+
+    def get_hash(self, values: list) -> str:
+        return hashlib.sha1("\n".join(values).encode("utf-8")).hexdigest()
+
+    def get(self, slug: str) -> tuple:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT listing, chapters FROM fingerprints WHERE slug = ?", (slug,)
+            ).fetchone()
+
+        return row or ("", "")
+
+    def set(self, slug: str, listing: str = "", chapters: str = "") -> None:
+        self.write(
+            "INSERT INTO fingerprints (slug, listing, chapters) VALUES (?, ?, ?) "
+            "ON CONFLICT(slug) DO UPDATE SET "
+            "listing = excluded.listing, chapters = excluded.chapters",
+            (slug, listing, chapters),
+        )
+
+    def delete(self, slug: str) -> None:
+        self.write("DELETE FROM fingerprints WHERE slug = ?", (slug,))
+
+    def clear(self) -> None:
+        self.write("DELETE FROM fingerprints")
+
+
+_fingerprint = Fingerprint()
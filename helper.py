@@ -1,28 +1,95 @@
+import hashlib
 import logging
 import mimetypes
 import os
+import tempfile
+import threading
 from datetime import datetime, timedelta
 from pathlib import Path
 from time import sleep
+from urllib.parse import urlsplit
 
 import boto3
 import requests
-from bs4 import BeautifulSoup
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
 from slugify import slugify
 
+from http_cache import _http_cache
+from metrics import _metrics
+from optimizer import CONTENT_TYPES, EXTENSIONS, _optimizer
+from profiler import _profiler
+from rate_limiter import RATE_LIMIT_RETRIES, RETRY_STATUSES, _rate_limiter
+from s3_manifest import _s3_manifest
 from settings import CONFIG
 
 logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=logging.INFO)
 
+# Number of hosts kept in the pool and keep-alive connections per host
+HTTP_POOL_HOSTS = getattr(CONFIG, "HTTP_POOL_HOSTS", 10)
+HTTP_POOL_SIZE = getattr(CONFIG, "HTTP_POOL_SIZE", 32)
+# (connect, read) timeout in seconds
+HTTP_TIMEOUT = getattr(CONFIG, "HTTP_TIMEOUT", (10, 60))
 
+IMAGE_CHUNK_SIZE = getattr(CONFIG, "IMAGE_CHUNK_SIZE", 64 * 1024)
+# Content-addressed copies of chapter images, hardlinked into chapter folders.
+# Must be on the same filesystem as IMAGE_SAVE_PATH, defaults to a folder in it
+IMAGE_HASH_PATH = getattr(CONFIG, "IMAGE_HASH_PATH", "")
+
+try:
+    import lxml  # noqa: F401
+
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+S3_UPLOAD_WORKERS = getattr(CONFIG, "S3_UPLOAD_WORKERS", 16)
+# Look for an existing object when an image is not in the local manifest
+S3_CHECK_EXISTING = getattr(CONFIG, "S3_CHECK_EXISTING", False)
+# Set to a local S3 stand-in (moto server, MinIO) to test uploads offline
+S3_ENDPOINT_URL = getattr(CONFIG, "S3_ENDPOINT_URL", None)
+# Images above this size are buffered on disk instead of in memory
+S3_SPOOL_SIZE = getattr(CONFIG, "S3_SPOOL_SIZE", 1024 * 1024)
+
+# One thread-safe client shared by every upload, with room for all of them
 s3 = boto3.client(
     "s3",
     aws_access_key_id=CONFIG.AWS_ACCESS_KEY_ID,
     aws_secret_access_key=CONFIG.AWS_SECRET_ACCESS_KEY,
+    endpoint_url=S3_ENDPOINT_URL,
+    config=Config(
+        max_pool_connections=S3_UPLOAD_WORKERS * 2,
+        retries={"max_attempts": 5, "mode": "adaptive"},
+    ),
+)
+s3_transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
 )
+s3_upload_slots = threading.BoundedSemaphore(S3_UPLOAD_WORKERS)
 
 
 class Helper:
+    def __init__(self) -> None:
+        self.session = self.get_session()
+
+    def get_session(self) -> requests.Session:
+        # requests has no HTTP/2 support, keep-alive pooling is what saves the
+        # TCP+TLS handshakes to nettruyen and its image CDN
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_HOSTS,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=2,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(self.get_header())
+        return session
+
     def get_header(self):
         header = {
             "User-Agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 14_0_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E150",  # noqa: E501
@@ -33,14 +100,70 @@ class Helper:
         }
         return header
 
-    def download_url(self, url):
-        return requests.get(url, headers=self.get_header())
+    def download_url(self, url, **kwargs):
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            # Paced per host, pages and images of every thread share the limit
+            sleep(_rate_limiter.reserve(url))
+            try:
+                response = self.session.get(url, **kwargs)
+            except requests.RequestException:
+                self.record_response(url)
+                raise
+
+            self.record_response(
+                url,
+                response.status_code,
+                response.elapsed.total_seconds(),
+                response.headers,
+            )
+            is_last_attempt = attempt == RATE_LIMIT_RETRIES
+            if response.status_code not in RETRY_STATUSES or is_last_attempt:
+                return response
+            response.close()
+
+    def record_response(
+        self, url: str, status: int = None, seconds: float = 0, headers=None
+    ) -> None:
+        # status None means the request did not get a response at all
+        _rate_limiter.feedback(url, status, seconds, headers)
 
-    def crawl_soup(self, url):
+        host = urlsplit(url).netloc
+        _metrics.inc("crawler_http_requests_total", host=host, status=status or "error")
+        if status:
+            _metrics.observe("crawler_http_request_seconds", seconds, host=host)
+
+    def parse_soup(
+        self, content: bytes, parse_only: SoupStrainer = None, page_type: str = ""
+    ):
+        with _metrics.time("crawler_parse_seconds", page_type=page_type):
+            return BeautifulSoup(content, HTML_PARSER, parse_only=parse_only)
+
+    def download_page(self, url: str, page_type: str = "") -> bytes:
+        content = _http_cache.get_fresh(url, page_type)
+        if content is not None:
+            return content
+
+        response = self.download_url(
+            url, headers=_http_cache.get_conditional_headers(url)
+        )
+        if response.status_code == 304:
+            content = _http_cache.revalidated(url)
+            if content is not None:
+                return content
+            response = self.download_url(url)
+
+        if response.status_code == 200:
+            _http_cache.store(url, response.headers, response.content, page_type)
+
+        return response.content
+
+    @_profiler.span
+    def crawl_soup(self, url, parse_only: SoupStrainer = None, page_type: str = ""):
         logging.info(f"[+] Crawling {url}")
 
-        html = self.download_url(url)
-        soup = BeautifulSoup(html.content, "html.parser")
+        html = self.download_page(url, page_type=page_type)
+        soup = self.parse_soup(html, parse_only=parse_only, page_type=page_type)
 
         return soup
 
@@ -49,6 +172,131 @@ class Helper:
         with open(f"log/{filename}", "a") as f:
             print(f"{msg}\n{'-' * 80}", file=f)
 
+    def stream_to_file(self, url: str, file_path: str) -> str:
+        # file_path only appears once the download is complete
+        tmp_path = f"{file_path}.part"
+        sha1 = hashlib.sha1()
+        size = 0
+        try:
+            with self.download_url(url, stream=True) as response:
+                response.raise_for_status()
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=IMAGE_CHUNK_SIZE):
+                        f.write(chunk)
+                        sha1.update(chunk)
+                        size += len(chunk)
+
+                content_length = response.headers.get("Content-Length")
+                is_encoded = response.headers.get("Content-Encoding")
+                if content_length and not is_encoded and int(content_length) != size:
+                    raise IOError(f"Truncated {url}: {size}/{content_length} bytes")
+
+            os.replace(tmp_path, file_path)
+            _metrics.inc("crawler_images_downloaded_total", storage="local")
+            _metrics.inc("crawler_image_bytes_total", size, storage="local")
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return sha1.hexdigest()
+
+    def get_hash_path(self, digest: str) -> str:
+        return os.path.join(
+            IMAGE_HASH_PATH or os.path.join(CONFIG.IMAGE_SAVE_PATH, ".hashes"),
+            digest[:2],
+            digest,
+        )
+
+    def get_file_hash(self, file_path: str) -> str:
+        sha1 = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(IMAGE_CHUNK_SIZE), b""):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def link_duplicate(self, file_path: str, digest: str) -> None:
+        hash_path = self.get_hash_path(digest)
+        Path(os.path.dirname(hash_path)).mkdir(parents=True, exist_ok=True)
+
+        try:
+            # The first copy of an image becomes the stored one
+            os.link(file_path, hash_path)
+            return
+        except FileExistsError:
+            pass
+        except OSError as e:
+            logging.warning(f"[-] Cannot hardlink {file_path}: {e}")
+            return
+
+        link_path = f"{file_path}.link"
+        try:
+            os.link(hash_path, link_path)
+            os.replace(link_path, file_path)
+        except OSError as e:
+            logging.warning(f"[-] Cannot hardlink {file_path}: {e}")
+            if os.path.exists(link_path):
+                os.remove(link_path)
+
+    def get_s3_key(self, file_name: str) -> str:
+        key = _s3_manifest.get(file_name)
+        if key or not S3_CHECK_EXISTING:
+            return key
+
+        objects = s3.list_objects_v2(
+            Bucket=CONFIG.S3_BUCKET, Prefix=f"{file_name}.", MaxKeys=1
+        )
+        if objects.get("KeyCount"):
+            key = objects["Contents"][0]["Key"]
+            _s3_manifest.set(file_name, key)
+        return key
+
+    def save_image_to_s3(
+        self, image_url: str, file_name: str, overwrite: bool = False
+    ) -> str:
+        # Uploaded before (this run or an earlier one), skip the download too
+        key = "" if overwrite else self.get_s3_key(file_name)
+        if key:
+            return key
+
+        # A seekable buffer lets boto3 retry and split the upload, and frees
+        # the HTTP connection before the upload starts
+        with tempfile.SpooledTemporaryFile(max_size=S3_SPOOL_SIZE) as image:
+            with self.download_url(image_url, stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=IMAGE_CHUNK_SIZE):
+                    image.write(chunk)
+                _metrics.inc("crawler_images_downloaded_total", storage="s3")
+                _metrics.inc("crawler_image_bytes_total", image.tell(), storage="s3")
+                content_type = response.headers.get("content-type", "")
+
+            extension = mimetypes.guess_extension(content_type.split(";")[0])
+            if not extension:
+                extension = ".jpg"
+
+            image.seek(0)
+            if _optimizer.is_enabled():
+                content, fmt = _optimizer.optimize_bytes(image.read())
+                if fmt:
+                    extension, content_type = EXTENSIONS[fmt], CONTENT_TYPES[fmt]
+                image.seek(0)
+                image.truncate()
+                image.write(content)
+                image.seek(0)
+
+            key = file_name + extension
+            with s3_upload_slots:
+                s3.upload_fileobj(
+                    image,
+                    CONFIG.S3_BUCKET,
+                    key,
+                    ExtraArgs={"ContentType": content_type or "image/jpeg"},
+                    Config=s3_transfer_config,
+                )
+
+        _s3_manifest.set(file_name, key)
+        return key
+
     def save_image(
         self,
         image_url: str,
@@ -63,18 +311,9 @@ class Helper:
                 file_name = slugify(
                     f"{comic_seo}-{chap_seo}-{image_name.replace('.jpg', '')}"
                 )
-                imageResponse = requests.get(
-                    image_url, headers=helper.get_header(), stream=True
-                ).raw
-                content_type = imageResponse.headers["content-type"]
-                extension = mimetypes.guess_extension(content_type)
-                if not extension:
-                    extension = ".jpg"
-                s3.upload_fileobj(
-                    imageResponse, CONFIG.S3_BUCKET, file_name + extension
-                )
-                return file_name + extension, False
-            except:
+                return self.save_image_to_s3(image_url, file_name, overwrite), False
+            except Exception as e:
+                logging.error(f"[-] Failed to upload {image_url}: {e}")
                 return "", True
 
         save_full_path = os.path.join(CONFIG.IMAGE_SAVE_PATH, comic_seo, chap_seo)
@@ -86,12 +325,14 @@ class Helper:
         if is_thumb:
             save_image = os.path.join(CONFIG.THUMB_SAVE_PATH, image_name)
 
-        is_not_saved = not Path(save_image).is_file()
+        is_not_saved = (
+            not Path(save_image).is_file() or os.path.getsize(save_image) == 0
+        )
 
         if overwrite or is_not_saved:
-            image = self.download_url(image_url)
-            with open(save_image, "wb") as f:
-                f.write(image.content)
+            digest = self.stream_to_file(image_url, save_image)
+            if not is_thumb:
+                self.link_duplicate(save_image, digest)
             is_not_saved = True
 
         return [save_image, is_not_saved]
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import time
+
+from settings import CONFIG
+from sqlite_store import SqliteStore
+
+HTTP_CACHE_PATH = getattr(CONFIG, "HTTP_CACHE_PATH", "data/http_cache")
+HTTP_CACHE_MAX_BYTES = getattr(CONFIG, "HTTP_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+# Seconds a page is served from the cache without asking the server, after
+# that it is revalidated with If-None-Match / If-Modified-Since
+HTTP_CACHE_TTL = getattr(
+    CONFIG,
+    "HTTP_CACHE_TTL",
+    {"listing": 0, "comic": 0, "chapter": 24 * 60 * 60},
+)
+
+
+class HttpCache(SqliteStore):
+    def __init__(self, path: str = HTTP_CACHE_PATH) -> None:
+        self.path = path
+        super().__init__(
+            os.path.join(path, "index.sqlite3"),
+            "CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, "
+            "etag TEXT, last_modified TEXT, fetched_at REAL, used_at REAL, "
+            "size INTEGER)",
+        )
+
+    def get_file(self, url: str) -> str:
+        return os.path.join(self.path, hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def get_entry(self, url: str) -> tuple:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT etag, last_modified, fetched_at FROM responses WHERE url = ?",
+                (url,),
+            ).fetchone()
+
+    def get_fresh(self, url: str, page_type: str) -> bytes:
+        entry = self.get_entry(url)
+        if not entry or time.time() - entry[2] >= HTTP_CACHE_TTL.get(page_type, 0):
+            return None
+
+        return self.read(url)
+
+    def get_conditional_headers(self, url: str) -> dict:
+        entry = self.get_entry(url)
+        if not entry or not os.path.isfile(self.get_file(url)):
+            return {}
+
+        etag, last_modified, _ = entry
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def read(self, url: str) -> bytes:
+        try:
+            with open(self.get_file(url), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+
+        self.write("UPDATE responses SET used_at = ? WHERE url = ?", (time.time(), url))
+        return content
+
+    def revalidated(self, url: str) -> bytes:
+        # 304 Not Modified, the stored body is current again
+        self.write(
+            "UPDATE responses SET fetched_at = ? WHERE url = ?", (time.time(), url)
+        )
+        return self.read(url)
+
+    def store(self, url: str, headers, content: bytes, page_type: str) -> None:
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified and not HTTP_CACHE_TTL.get(page_type, 0):
+            return
+
+        file = self.get_file(url)
+        tmp_file = f"{file}.part"
+        with open(tmp_file, "wb") as f:
+            f.write(content)
+        os.replace(tmp_file, file)
+
+        now = time.time()
+        self.write(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+            (url, etag, last_modified, now, now, len(content)),
+        )
+
+        self.evict()
+
+    def evict(self) -> None:
+        # Drop the least recently used pages until the cache fits its budget
+        with self.lock:
+            total = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+            if total <= HTTP_CACHE_MAX_BYTES:
+                return
+
+            evicted = []
+            for url, size in self.conn.execute(
+                "SELECT url, size FROM responses ORDER BY used_at"
+            ).fetchall():
+                if total <= HTTP_CACHE_MAX_BYTES:
+                    break
+                evicted.append((url,))
+                total -= size
+
+            self.conn.executemany("DELETE FROM responses WHERE url = ?", evicted)
+            self.conn.commit()
+
+        for (url,) in evicted:
+            if os.path.exists(self.get_file(url)):
+                os.remove(self.get_file(url))
+
+
+_http_cache = HttpCache()
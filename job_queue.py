@@ -0,0 +1,152 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from settings import CONFIG
+
+JOB_QUEUE_DB = getattr(CONFIG, "JOB_QUEUE_DB", "data/jobs.sqlite3")
+JOB_MAX_ATTEMPTS = getattr(CONFIG, "JOB_MAX_ATTEMPTS", 5)
+# Seconds before the first retry, doubled on every further attempt
+JOB_RETRY_DELAY = getattr(CONFIG, "JOB_RETRY_DELAY", 60)
+# A running job older than this belongs to a dead worker and is taken over
+JOB_LOCK_TIMEOUT = getattr(CONFIG, "JOB_LOCK_TIMEOUT", 30 * 60)
+
+# Front page work from update.py goes before backfill from crawl_all.py
+PRIORITY_UPDATE = 100
+PRIORITY_BACKFILL = 0
+
+
+class Job:
+    def __init__(self, id: int, type: str, payload: str, priority: int) -> None:
+        self.id = id
+        self.type = type
+        self.payload = json.loads(payload)
+        self.priority = priority
+
+
+class JobQueue:
+    def __init__(self, path: str = JOB_QUEUE_DB) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        # Shared by several worker processes, autocommit with explicit BEGIN
+        self.conn = sqlite3.connect(
+            path, timeout=60, check_same_thread=False, isolation_level=None
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY, type TEXT, key TEXT, payload TEXT, "
+            "priority INTEGER, status TEXT, attempts INTEGER, available_at REAL, "
+            "locked_at REAL, error TEXT, UNIQUE (type, key))"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_next "
+            "ON jobs (status, priority DESC, available_at)"
+        )
+
+    def put(self, type: str, key: str, payload: dict, priority: int) -> None:
+        # A job already queued keeps its place but takes the higher priority,
+        # a finished one is queued again with the new priority, right away.
+        # Every CASE reads the status the row had before this statement
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO jobs (type, key, payload, priority, status, attempts, "
+                "available_at) VALUES (?, ?, ?, ?, 'pending', 0, ?) "
+                "ON CONFLICT (type, key) DO UPDATE SET "
+                "payload = excluded.payload, "
+                "priority = CASE WHEN status = 'pending' "
+                "THEN MAX(priority, excluded.priority) ELSE excluded.priority END, "
+                "available_at = CASE WHEN status IN ('done', 'failed') "
+                "THEN excluded.available_at ELSE available_at END, "
+                "status = CASE WHEN status = 'running' THEN status ELSE 'pending' END, "
+                "attempts = CASE WHEN status = 'pending' THEN attempts ELSE 0 END",
+                (type, key, json.dumps(payload), priority, time.time()),
+            )
+
+    def put_page(self, page: int, priority: int) -> None:
+        self.put("page", str(page), {"page": page}, priority)
+
+    def put_comic(self, priority: int, href: str, listing_fingerprint: str = ""):
+        self.put(
+            "comic",
+            href,
+            {"href": href, "listing_fingerprint": listing_fingerprint},
+            priority,
+        )
+
+    def put_chapter(self, priority: int, **payload) -> None:
+        # payload["chapter"] is a ChapterRecord.to_dict()
+        self.put("chapter", payload["chapter"]["href"], payload, priority)
+
+    def get(self) -> Job:
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT id, type, payload, priority FROM jobs "
+                    "WHERE (status = 'pending' AND available_at <= ?) "
+                    "OR (status = 'running' AND locked_at <= ?) "
+                    "ORDER BY priority DESC, id LIMIT 1",
+                    (now, now - JOB_LOCK_TIMEOUT),
+                ).fetchone()
+                if row:
+                    self.conn.execute(
+                        "UPDATE jobs SET status = 'running', locked_at = ? "
+                        "WHERE id = ?",
+                        (now, row[0]),
+                    )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+        return Job(*row) if row else None
+
+    def done(self, job: Job) -> None:
+        with self.lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'done', error = NULL WHERE id = ?",
+                (job.id,),
+            )
+
+    def fail(self, job: Job, error: str) -> bool:
+        # True once the job has used up its attempts
+        with self.lock:
+            attempts = self.conn.execute(
+                "SELECT attempts FROM jobs WHERE id = ?", (job.id,)
+            ).fetchone()[0]
+            attempts += 1
+            status = "failed" if attempts >= JOB_MAX_ATTEMPTS else "pending"
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, available_at = ?, "
+                "error = ? WHERE id = ?",
+                (
+                    status,
+                    attempts,
+                    time.time() + JOB_RETRY_DELAY * 2 ** (attempts - 1),
+                    error,
+                    job.id,
+                ),
+            )
+        return status == "failed"
+
+    def count(self, type: str = "") -> dict:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE type = ? OR ? = '' "
+                "GROUP BY status",
+                (type, type),
+            ).fetchall()
+
+        return dict(rows)
+
+    def is_busy(self, type: str) -> bool:
+        counts = self.count(type)
+        return bool(counts.get("pending") or counts.get("running"))
+
+    def get_depth(self) -> dict:
+        # Labels -> jobs, read by the crawler_jobs gauge of metrics.py
+        return {(("status", status),): count for status, count in self.count().items()}
@@ -1,50 +1,140 @@
 import logging
 import os
+import re
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-import pytz
 from phpserialize import serialize
 from PIL import Image
 from slugify import slugify
 
-from _db import Database
-from chapter import _chapter
+from _db import Database, get_in
+from chapter import ChapterRecord, get_timeupdate
 from helper import helper
+from metrics import _metrics
+from optimizer import _optimizer
+from profiler import _profiler
 from settings import CONFIG
 
 logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=logging.INFO)
 
-vn_timezone = pytz.timezone("Asia/Ho_Chi_Minh")
+IMAGE_WORKERS_PER_CHAPTER = getattr(CONFIG, "IMAGE_WORKERS_PER_CHAPTER", 8)
+IMAGE_WORKERS_GLOBAL = getattr(CONFIG, "IMAGE_WORKERS_GLOBAL", 16)
+
+image_executor = ThreadPoolExecutor(
+    max_workers=IMAGE_WORKERS_GLOBAL, thread_name_prefix="image"
+)
+
+# comic_id -> set of chapter slugs already in manga_chapters, shared by every
+# Madara in the process so it survives the new Crawler of each update.py pass.
+# Only a hint, chapters other processes insert are checked in the database
+chapters_slug_cache = {}
+# (taxonomy, slug) -> (term_taxonomy_id, term_id), only holds committed terms
+terms_cache = {}
+# Held from the first term lookup of a comic until its transaction commits,
+# so two threads never both miss a new term and insert it twice
+terms_lock = threading.Lock()
 
 
 class Madara:
     def __init__(self, database: Database) -> None:
         self.database = database
+        self.chapters_slug_cache = chapters_slug_cache
+        self.terms_cache = terms_cache
+        # Terms inserted by the transaction in progress
+        self.pending_terms = {}
 
-    def get_backend_chapters_slug(self, comic_id: int) -> list:
+    def load_chapters_slug_cache(self) -> None:
         chapters = self.database.select_all_from(
-            table=f"manga_chapters",
-            condition=f'post_id="{comic_id}"',
+            table=f"manga_chapters", cols="post_id, chapter_slug"
+        )
+
+        self.chapters_slug_cache.clear()
+        for comic_id, chapter_slug in chapters:
+            self.chapters_slug_cache.setdefault(comic_id, set()).add(chapter_slug)
+
+    def get_backend_chapters_slug(self, comic_id: int, chapter_slugs: list = ()) -> set:
+        if comic_id not in self.chapters_slug_cache:
+            chapters = self.database.select_all_from(
+                table=f"manga_chapters",
+                condition="post_id = %s",
+                cols="chapter_slug",
+                params=(comic_id,),
+            )
+            self.chapters_slug_cache[comic_id] = {chapter[0] for chapter in chapters}
+            return self.chapters_slug_cache[comic_id]
+
+        # Slugs of chapter_slugs the cache misses may have been inserted by
+        # crawl_all.py, update.py, a queue worker or bulk_import.py since
+        missing_slugs = [
+            chapter_slug
+            for chapter_slug in chapter_slugs
+            if chapter_slug not in self.chapters_slug_cache[comic_id]
+        ]
+        if missing_slugs:
+            chapters = self.database.select_all_from(
+                table=f"manga_chapters",
+                condition=f"post_id = %s AND {get_in('chapter_slug', missing_slugs)}",
+                cols="chapter_slug",
+                params=(comic_id, *missing_slugs),
+            )
+            self.chapters_slug_cache[comic_id].update(
+                chapter[0] for chapter in chapters
+            )
+
+        return self.chapters_slug_cache[comic_id]
+
+    def load_terms_cache(self) -> None:
+        terms = self.database.select_with(
+            query=f"""SELECT tt.taxonomy, t.slug, tt.term_taxonomy_id, tt.term_id
+                FROM {CONFIG.TABLE_PREFIX}term_taxonomy tt, {CONFIG.TABLE_PREFIX}terms t
+                WHERE tt.term_id=t.term_id AND tt.taxonomy LIKE %s""",
+            params=("wp-manga%",),
         )
 
-        chapters_slug = [chapter[5] for chapter in chapters]
-        return chapters_slug
+        for taxonomy, slug, term_taxonomy_id, term_id in terms:
+            self.terms_cache[(taxonomy, slug)] = (term_taxonomy_id, term_id)
+
+    def get_term(self, taxonomy: str, term_slug: str) -> tuple:
+        if not self.terms_cache:
+            self.load_terms_cache()
+
+        key = (taxonomy, term_slug)
+        if key in self.pending_terms:
+            return self.pending_terms[key]
+        if key in self.terms_cache:
+            return self.terms_cache[key]
+
+        cols = "tt.term_taxonomy_id, tt.term_id"
+        table = f"{CONFIG.TABLE_PREFIX}term_taxonomy tt, {CONFIG.TABLE_PREFIX}terms t"
+        condition = "t.slug = %s AND tt.term_id=t.term_id AND tt.taxonomy = %s"
+
+        query = f"SELECT {cols} FROM {table} WHERE {condition}"
+
+        be_term = self.database.select_with(
+            query=query, params=(term_slug, taxonomy), prepared=True
+        )
+        if not be_term:
+            return ()
+
+        self.terms_cache[key] = tuple(be_term[0])
+        return self.terms_cache[key]
 
     def insert_postmeta(self, postmeta_data: list, table: str = "postmeta"):
         self.database.insert_into(table=table, data=postmeta_data, is_bulk=True)
 
     def get_timeupdate(self) -> str:
         # TODO: later
-        timeupdate = datetime.now(vn_timezone).strftime("%Y/%m/%d %H:%M:%S")
-
-        return timeupdate
+        return get_timeupdate()
 
     def get_comic_timeupdate(self) -> str:
         # TODO
         return int(time.time())
 
     def download_and_save_thumb(self, cover_url: str):
+        thumb_save_path = ""
         try:
             # Download the cover image
             image_name = cover_url.split("/")[-1]
@@ -92,18 +182,22 @@ class Madara:
         )
         return _wp_attachment_metadata
 
-    def insert_thumb(self, cover_url: str) -> int:
-        if not cover_url:
-            return 0
+    def insert_thumb(self, saved_thumb_url: str, thumb_save_path: str) -> tuple:
+        if not saved_thumb_url:
+            return 0, []
 
-        saved_thumb_url, thumb_save_path = self.download_and_save_thumb(
-            cover_url=cover_url
+        thumb_id = self.database.insert_into(
+            table="posts", data=self.get_thumb_post_data(saved_thumb_url)
+        )
+        return thumb_id, self.get_thumb_postmeta(
+            thumb_id, saved_thumb_url, thumb_save_path
         )
 
+    def get_thumb_post_data(self, saved_thumb_url: str) -> tuple:
         thumb_name = saved_thumb_url.split("/")[-1]
 
         timeupdate = self.get_timeupdate()
-        thumb_post_data = (
+        return (
             0,
             timeupdate,
             timeupdate,
@@ -129,9 +223,10 @@ class Madara:
             "",
         )
 
-        thumb_id = self.database.insert_into(table="posts", data=thumb_post_data)
-
-        postmeta_data = [
+    def get_thumb_postmeta(
+        self, thumb_id: int, saved_thumb_url: str, thumb_save_path: str
+    ) -> list:
+        return [
             (thumb_id, "_wp_attached_file", saved_thumb_url),
             (
                 thumb_id,
@@ -142,19 +237,6 @@ class Madara:
             ),
         ]
 
-        self.insert_postmeta(postmeta_data)
-        # self.database.insert_into(
-        #     table="postmeta",
-        #     data=(thumb_id, "_wp_attached_file", saved_thumb_url),
-        # )
-
-        # self.database.insert_into(
-        #     table="postmeta",
-        #     data=(thumb_id, "_wp_attached_file", saved_thumb_url),
-        # )
-
-        return thumb_id
-
     def insert_terms(
         self,
         post_id: int,
@@ -162,27 +244,19 @@ class Madara:
         taxonomy: str,
         is_title: str = False,
         term_slug: str = "",
-    ):
+    ) -> list:
         try:
             terms = (
                 [term.strip() for term in terms.split("-")] if not is_title else [terms]
             )
         except Exception as e:
             logging.error(f"[-] Error in insert terms: {terms}")
-            return
+            return []
 
-        term_ids = []
+        term_relationships = []
         for term in terms:
             term_insert_slug = slugify(term_slug) if term_slug else slugify(term)
-            cols = "tt.term_taxonomy_id, tt.term_id"
-            table = (
-                f"{CONFIG.TABLE_PREFIX}term_taxonomy tt, {CONFIG.TABLE_PREFIX}terms t"
-            )
-            condition = f't.slug = "{term_insert_slug}" AND tt.term_id=t.term_id AND tt.taxonomy="{taxonomy}"'
-
-            query = f"SELECT {cols} FROM {table} WHERE {condition}"
-
-            be_term = self.database.select_with(query=query)
+            be_term = self.get_term(taxonomy=taxonomy, term_slug=term_insert_slug)
             if not be_term:
                 term_id = self.database.insert_into(
                     table="terms",
@@ -193,26 +267,57 @@ class Madara:
                     table="term_taxonomy",
                     data=(term_id, taxonomy, "", 0, term_taxonomy_count),
                 )
-                term_ids = [term_taxonomy_id, True]
+                self.pending_terms[(taxonomy, term_insert_slug)] = (
+                    term_taxonomy_id,
+                    term_id,
+                )
             else:
-                term_taxonomy_id = be_term[0][0]
-                term_id = be_term[0][1]
-                term_ids = [term_taxonomy_id, False]
+                term_taxonomy_id, term_id = be_term
 
-            try:
-                self.database.insert_into(
-                    table="term_relationships",
-                    data=(post_id, term_taxonomy_id, 0),
+            term_relationships.append((post_id, term_taxonomy_id, 0))
+
+        return term_relationships
+
+    @_profiler.span
+    def insert_comic(self, comic_data: dict, thumb: tuple = None):
+        # Download the cover before opening the transaction, AsyncCrawler
+        # passes it in so its database thread never waits on the download
+        saved_thumb_url, thumb_save_path = thumb or self.get_thumb(comic_data)
+
+        data = self.get_comic_post_data(comic_data)
+
+        try:
+            with self.terms_transaction():
+                comic_id = self.insert_comic_rows(
+                    data=data,
+                    comic_data=comic_data,
+                    saved_thumb_url=saved_thumb_url,
+                    thumb_save_path=thumb_save_path,
                 )
-            except:
-                pass
+        except Exception as e:
+            helper.error_log(
+                msg=f"Failed to insert comic\n{e}", filename="helper.comic_id.log"
+            )
+            return 0
+        return comic_id
 
-        return term_ids
+    @contextmanager
+    def terms_transaction(self):
+        # A transaction that may insert terms, see terms_lock
+        with terms_lock:
+            self.pending_terms = {}
+            try:
+                with self.database.transaction():
+                    yield
+            finally:
+                pending_terms, self.pending_terms = self.pending_terms, {}
 
-    def insert_comic(self, comic_data: dict):
-        thumb_id = self.insert_thumb(comic_data.get("cover_url"))
+            # The new terms only exist once the transaction is committed
+            self.terms_cache.update(pending_terms)
+
+    def get_comic_post_data(self, comic_data: dict) -> tuple:
         timeupdate = self.get_timeupdate()
-        data = (
+        return (
             0,
             timeupdate,
             timeupdate,
@@ -238,15 +343,34 @@ class Madara:
             "",
         )
 
-        try:
-            comic_id = self.database.insert_into(table=f"posts", data=data)
-        except Exception as e:
-            helper.error_log(
-                msg=f"Failed to insert comic\n{e}", filename="helper.comic_id.log"
-            )
-            return 0
+    def insert_comic_rows(
+        self,
+        data: tuple,
+        comic_data: dict,
+        saved_thumb_url: str,
+        thumb_save_path: str,
+    ) -> int:
+        thumb_id, postmeta_data = self.insert_thumb(
+            saved_thumb_url=saved_thumb_url, thumb_save_path=thumb_save_path
+        )
+        comic_id = self.database.insert_into(table=f"posts", data=data)
+
+        postmeta_data += self.get_comic_postmeta(comic_id, thumb_id, comic_data)
+        self.insert_postmeta(postmeta_data)
+
+        self.database.insert_into(
+            table="term_relationships",
+            data=self.get_comic_term_relationships(comic_id, comic_data),
+            is_bulk=True,
+            ignore=True,
+        )
 
-        postmeta_data = [
+        return comic_id
+
+    def get_comic_postmeta(
+        self, comic_id: int, thumb_id: int, comic_data: dict
+    ) -> list:
+        return [
             (comic_id, "_latest_update", f"{self.get_comic_timeupdate()}"),
             (comic_id, "_thumbnail_id", thumb_id),
             (
@@ -260,69 +384,142 @@ class Madara:
             (comic_id, "_wp_manga_chapter_type", "text"),
         ]
 
-        self.insert_postmeta(postmeta_data)
-
-        self.insert_terms(
+    def get_comic_term_relationships(self, comic_id: int, comic_data: dict) -> list:
+        # Inserts the terms the comic is the first to use
+        term_relationships = self.insert_terms(
             post_id=comic_id,
             terms=comic_data.get("tac-gia", ""),
             taxonomy="wp-manga-author",
         )
-        self.insert_terms(
+        term_relationships += self.insert_terms(
             post_id=comic_id,
             terms=comic_data.get("the-loai", ""),
             taxonomy="wp-manga-genre",
         )
-
-        return comic_id
-
-    def get_or_insert_comic(self, comic_details: dict) -> int:
-        condition = f"""post_name = '{comic_details["slug"]}'"""
-        be_post = self.database.select_all_from(table=f"posts", condition=condition)
+        return term_relationships
+
+    def get_thumb(self, comic_data: dict) -> tuple:
+        if not comic_data.get("cover_url"):
+            return "", ""
+        return self.download_and_save_thumb(cover_url=comic_data.get("cover_url"))
+
+    def get_or_insert_comic(self, comic_details: dict, thumb: tuple = None) -> int:
+        be_post = self.database.select_all_from(
+            table=f"posts",
+            condition="post_name = %s",
+            cols="ID",
+            params=(comic_details["slug"],),
+            prepared=True,
+        )
         if not be_post:
-            return self.insert_comic(comic_data=comic_details)
+            return self.insert_comic(comic_data=comic_details, thumb=thumb)
         else:
             return be_post[0][0]
 
-    def get_download_chapter_content(
+    def download_chapter_image(
+        self, comic_slug: str, chapter_slug: str, image_number: str, image_src: str
+    ) -> str:
+        saved_image, is_failed = helper.save_image(
+            image_url=image_src,
+            comic_seo=comic_slug,
+            chap_seo=chapter_slug,
+            image_name=f"{image_number}.jpg",
+        )
+        if CONFIG.SAVE_CHAPTER_IMAGES_TO_S3:
+            if is_failed or not saved_image:
+                raise Exception(f"Failed to upload {image_src} to S3")
+            return f"{CONFIG.S3_BUCKET_IMAGE_URL_PREFIX}/{saved_image}"
+
+        if _optimizer.is_enabled():
+            saved_image = _optimizer.optimize_file(saved_image)
+
+        return saved_image.replace(CONFIG.IMAGE_SAVE_PATH, CONFIG.CUSTOM_CDN)
+
+    def get_chapter_content(
         self,
         comic_title: str,
-        comic_slug: str,
-        chapter_details: dict,
         chapter_name: str,
-    ):
+        chapter_details: dict,
+        saved_images: dict,
+    ) -> tuple:
         result = CONFIG.CHAPTER_PREFIX.format(
             comic_name=comic_title,
             chapter=chapter_name.lower().replace("chapter", "").strip(),
         )
+
+        failed_images = []
+        for image_number, image_details in chapter_details.items():
+            img_src = saved_images.get(image_number)
+            if not img_src:
+                failed_images.append(image_details.get("src"))
+                continue
+
+            result += "\n" + CONFIG.IMAGE_ELEMENT.format(
+                img_src=img_src, img_alt=image_details.get("alt")
+            )
+
+        return result, failed_images
+
+    def get_download_chapter_content(
+        self,
+        comic_title: str,
+        comic_slug: str,
+        chapter_details: dict,
+        chapter: ChapterRecord,
+    ) -> tuple:
+        # Already in reading order, see Chapter.get_chapter_detail
         image_numbers = list(chapter_details.keys())
-        # sorted(image_numbers, key=lambda x: int(x))
 
+        # Bound the number of in-flight images of this chapter, the global
+        # limit is the size of image_executor shared by every chapter
+        chapter_slots = threading.BoundedSemaphore(IMAGE_WORKERS_PER_CHAPTER)
+        futures = {}
         for image_number in image_numbers:
-            image_details = chapter_details[image_number]
-            image_alt = image_details.get("alt")
-            image_src = image_details.get("src")
-            saved_image, _ = helper.save_image(
-                image_url=image_src,
-                comic_seo=comic_slug,
-                chap_seo=_chapter.get_chapter_slug(chapter_name=chapter_name),
-                image_name=f"{image_number}.jpg",
-            )
-            if CONFIG.SAVE_CHAPTER_IMAGES_TO_S3:
-                img_src = f"{CONFIG.S3_BUCKET_IMAGE_URL_PREFIX}/{saved_image}"
-            else:
-                img_src = saved_image.replace(CONFIG.IMAGE_SAVE_PATH, CONFIG.CUSTOM_CDN)
-            result += "\n" + CONFIG.IMAGE_ELEMENT.format(
-                img_src=img_src, img_alt=image_alt
+            chapter_slots.acquire()
+            future = image_executor.submit(
+                self.download_chapter_image,
+                comic_slug=comic_slug,
+                chapter_slug=chapter.slug,
+                image_number=image_number,
+                image_src=chapter_details[image_number].get("src"),
             )
+            future.add_done_callback(lambda _: chapter_slots.release())
+            futures[image_number] = future
 
-        return result
+        saved_images = {}
+        for image_number, future in futures.items():
+            try:
+                saved_images[image_number] = future.result()
+            except Exception as e:
+                logging.error(f"[-] Failed image {image_number}: {e}")
+
+        return self.get_chapter_content(
+            comic_title=comic_title,
+            chapter_name=chapter.name,
+            chapter_details=chapter_details,
+            saved_images=saved_images,
+        )
 
     def insert_chapter_content_to_posts(
-        self, chapter_id: int, chapter_slug: str, content: str
+        self, chapter_id: int, chapter: ChapterRecord, content: str
     ):
-        chapter_post_slug = slugify(f"{chapter_id}-{chapter_slug}")
-        timeupdate = self.get_timeupdate()
-        data = (
+        chapter_post_slug = slugify(f"{chapter_id}-{chapter.slug}")
+        self.database.select_or_insert(
+            table="posts",
+            condition="post_name = %s",
+            data=self.get_chapter_post_data(chapter_id, chapter, content),
+            params=(chapter_post_slug,),
+            cols="ID",
+            prepared=True,
+        )
+        # self.database.insert_into(table=f"posts", data=data)
+
+    def get_chapter_post_data(
+        self, chapter_id: int, chapter: ChapterRecord, content: str
+    ) -> tuple:
+        chapter_post_slug = slugify(f"{chapter_id}-{chapter.slug}")
+        timeupdate = chapter.timeupdate
+        return (
             0,
             timeupdate,
             timeupdate,
@@ -348,54 +545,171 @@ class Madara:
             "",
         )
 
-        try:
-            condition = f"post_name='{chapter_post_slug}'"
-            self.database.select_or_insert(
-                table="posts", condition=condition, data=data
-            )
-            # self.database.insert_into(table=f"posts", data=data)
-        except Exception as e:
-            helper.error_log(
-                msg=f"Failed to insert comic\n{e}",
-                filename="madara.insert_chapter_content_to_posts.log",
-            )
-            return 0
-
-    def insert_chapter(
-        self,
-        comic_id: int,
-        chapter_name: str,
-        content: str,
-    ):
-        data = (
+    def get_chapter_data(self, comic_id: int, chapter: ChapterRecord) -> tuple:
+        return (
             comic_id,
             0,
-            chapter_name,
+            chapter.name,
             "",
-            _chapter.get_chapter_slug(chapter_name=chapter_name),
+            chapter.slug,
             "",
-            self.get_timeupdate(),
-            self.get_timeupdate(),
+            chapter.timeupdate,
+            chapter.timeupdate,
             0,
             "",
             "",
             0,
             "",
         )
-        condition = f"post_id={comic_id} AND chapter_slug='{_chapter.get_chapter_slug(chapter_name=chapter_name)}'"
-        chapter_id = self.database.select_or_insert(
+
+    @_profiler.span
+    def insert_chapter(
+        self,
+        comic_id: int,
+        chapter: ChapterRecord,
+        content: str,
+    ) -> bool:
+        data = self.get_chapter_data(comic_id, chapter)
+        try:
+            # The chapter row and its content post are written together
+            with self.database.transaction():
+                chapter_id = self.database.select_or_insert(
+                    table="manga_chapters",
+                    condition="post_id = %s AND chapter_slug = %s",
+                    data=data,
+                    params=(comic_id, chapter.slug),
+                    cols="chapter_id",
+                    prepared=True,
+                )[0][0]
+                # chapter_id = self.database.insert_into(table=f"manga_chapters", data=data)
+
+                # self.database.insert_into(
+                #     table=f"manga_chapters_data",
+                #     data=(chapter_id, "local", content),
+                # )
+                self.insert_chapter_content_to_posts(
+                    chapter_id=chapter_id,
+                    chapter=chapter,
+                    content=content,
+                )
+        except Exception as e:
+            helper.error_log(
+                msg=f"Failed to insert chapter {chapter.name} of {comic_id}\n{e}",
+                filename="madara.insert_chapter.log",
+            )
+            return False
+
+        self.get_backend_chapters_slug(comic_id).add(chapter.slug)
+        _metrics.inc("crawler_chapters_inserted_total")
+        return True
+
+    def get_comic_id(self, comic_slug: str) -> int:
+        be_post = self.database.select_all_from(
+            table="posts",
+            condition="post_name = %s AND post_type = %s",
+            cols="ID",
+            params=(comic_slug, "wp-manga"),
+        )
+        return be_post[0][0] if be_post else 0
+
+    def get_chapters(self, comic_id: int) -> dict:
+        chapters = self.database.select_all_from(
             table="manga_chapters",
-            condition=condition,
-            data=data,
-        )[0][0]
-        # chapter_id = self.database.insert_into(table=f"manga_chapters", data=data)
-
-        # self.database.insert_into(
-        #     table=f"manga_chapters_data",
-        #     data=(chapter_id, "local", content),
-        # )
-        self.insert_chapter_content_to_posts(
-            chapter_id=chapter_id,
-            chapter_slug=_chapter.get_chapter_slug(chapter_name=chapter_name),
-            content=content,
+            condition="post_id = %s",
+            cols="chapter_slug, chapter_id",
+            params=(comic_id,),
+        )
+        return dict(chapters)
+
+    def get_chapter_posts(self, chapter_ids: list) -> list:
+        # The chapter_text_content posts insert_chapter_content_to_posts wrote
+        if not chapter_ids:
+            return []
+
+        return self.database.select_all_from(
+            table="posts",
+            condition=f"post_type = %s AND {get_in('post_parent', chapter_ids)}",
+            cols="ID, post_content",
+            params=("chapter_text_content", *chapter_ids),
+        )
+
+    def delete_posts(self, post_ids: list) -> None:
+        if not post_ids:
+            return
+
+        self.database.delete_from(
+            table="postmeta",
+            condition=get_in("post_id", post_ids),
+            params=tuple(post_ids),
+        )
+        self.database.delete_from(
+            table="posts", condition=get_in("ID", post_ids), params=tuple(post_ids)
+        )
+
+    def delete_chapters(self, comic_id: int, chapter_ids: list) -> list:
+        # Returns the image urls of the deleted chapters, the files are only
+        # removed by the caller once the transaction is committed
+        chapter_posts = self.get_chapter_posts(chapter_ids)
+        image_urls = [
+            url
+            for _, content in chapter_posts
+            for url in re.findall(r"""src=["']([^"']+)["']""", content or "")
+        ]
+
+        self.delete_posts([post_id for post_id, _ in chapter_posts])
+        if chapter_ids:
+            self.database.delete_from(
+                table="manga_chapters",
+                condition=f"post_id = %s AND {get_in('chapter_id', chapter_ids)}",
+                params=(comic_id, *chapter_ids),
+            )
+
+        # Reloaded from manga_chapters on the next lookup
+        self.chapters_slug_cache.pop(comic_id, None)
+        return image_urls
+
+    def delete_comic(self, comic_id: int) -> tuple:
+        # Returns (cover file, image urls), see delete_chapters
+        thumbnail = self.database.select_with(
+            query=f"""SELECT p.ID, m2.meta_value
+                FROM {CONFIG.TABLE_PREFIX}postmeta m
+                JOIN {CONFIG.TABLE_PREFIX}posts p ON p.ID = m.meta_value
+                LEFT JOIN {CONFIG.TABLE_PREFIX}postmeta m2
+                    ON m2.post_id = p.ID AND m2.meta_key = '_wp_attached_file'
+                WHERE m.post_id = %s AND m.meta_key = '_thumbnail_id'
+                    AND p.post_type = 'attachment'""",
+            params=(comic_id,),
+        )
+
+        image_urls = self.delete_chapters(
+            comic_id, list(self.get_chapters(comic_id).values())
+        )
+        self.database.delete_from(
+            table="term_relationships", condition="object_id = %s", params=(comic_id,)
+        )
+        self.database.delete_from(
+            table="manga_volumes", condition="post_id = %s", params=(comic_id,)
+        )
+        self.delete_posts([comic_id] + [thumb_id for thumb_id, _ in thumbnail])
+
+        attached_file = thumbnail[0][1] if thumbnail else ""
+        if not self.is_cover_unused(attached_file):
+            return "", image_urls
+        return (
+            os.path.join(CONFIG.THUMB_SAVE_PATH, attached_file.split("/", 1)[1]),
+            image_urls,
+        )
+
+    def is_cover_unused(self, attached_file: str) -> bool:
+        # Only covers this crawler saved, and never the DEFAULT_THUMB every
+        # comic without a cover shares or a file another attachment still uses
+        if not attached_file or not attached_file.startswith("covers/"):
+            return False
+        if attached_file == CONFIG.DEFAULT_THUMB:
+            return False
+        return not self.database.select_all_from(
+            table="postmeta",
+            condition="meta_key = %s AND meta_value = %s LIMIT 1",
+            cols="post_id",
+            params=("_wp_attached_file", attached_file),
         )
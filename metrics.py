@@ -0,0 +1,167 @@
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+from settings import CONFIG
+
+# Port of the local /metrics endpoint, 0 turns it off
+METRICS_PORT = getattr(CONFIG, "METRICS_PORT", 0)
+METRICS_HOST = getattr(CONFIG, "METRICS_HOST", "127.0.0.1")
+
+# Upper bounds in seconds, from a cached SQL lookup up to a slow image
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def get_key(name: str, labels: dict) -> tuple:
+    # Values as strings, so series with 200 and "error" statuses still sort
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # (name, labels) -> value, labels being sorted (key, value) pairs
+        self.counters = {}
+        # (name, labels) -> [count per bucket, sum, count]
+        self.histograms = {}
+        # name -> function returning {labels: value}, read on every scrape
+        self.gauges = {}
+        self.server = None
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = get_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = get_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start, **labels)
+
+    def set_gauge(self, name: str, func) -> None:
+        self.gauges[name] = func
+
+    def render(self) -> str:
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, (list(buckets), total, count))
+                for key, (buckets, total, count) in self.histograms.items()
+            )
+
+        lines = []
+        for (name, labels), value in counters:
+            lines.append(f"{name}{format_labels(labels)} {value:g}")
+
+        for (name, labels), (buckets, total, count) in histograms:
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                le = format_labels(labels + (("le", f"{bound:g}"),))
+                lines.append(f"{name}_bucket{le} {cumulative}")
+            le = format_labels(labels + (("le", "+Inf"),))
+            lines.append(f"{name}_bucket{le} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total:g}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+
+        for name, func in sorted(self.gauges.items()):
+            try:
+                values = func()
+            except Exception as e:
+                logging.error(f"[-] Cannot read gauge {name}: {e}")
+                continue
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{format_labels(labels)} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {
+                    key: (total, count)
+                    for key, (_, total, count) in self.histograms.items()
+                },
+            }
+
+    def get_summary(self, since: dict) -> str:
+        # What happened after the since snapshot, one line per series
+        now = self.snapshot()
+        lines = []
+        for key, value in sorted(now["counters"].items()):
+            delta = value - since["counters"].get(key, 0)
+            if delta:
+                lines.append(f"{key[0]}{format_labels(key[1])} {delta:g}")
+
+        for key, (total, count) in sorted(now["histograms"].items()):
+            since_total, since_count = since["histograms"].get(key, (0, 0))
+            count -= since_count
+            total -= since_total
+            if count:
+                lines.append(
+                    f"{key[0]}{format_labels(key[1])} count={count} "
+                    f"total={total:.2f}s avg={total / count:.3f}s"
+                )
+
+        return "\n".join(lines)
+
+    def serve(self, port: int = METRICS_PORT) -> None:
+        if not port or self.server:
+            return
+
+        try:
+            self.server = ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+        except OSError as e:
+            logging.error(f"[-] Cannot serve metrics on port {port}: {e}")
+            return
+
+        self.server.daemon_threads = True
+        self.server.metrics = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logging.info(f"[+] Metrics on http://{METRICS_HOST}:{port}/metrics")
+
+
+_metrics = Metrics()
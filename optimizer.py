@@ -0,0 +1,132 @@
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from settings import CONFIG
+
+# "" keeps images as fetched, "webp" or "jpeg" re-encodes them
+IMAGE_OPTIMIZE_FORMAT = getattr(CONFIG, "IMAGE_OPTIMIZE_FORMAT", "")
+IMAGE_OPTIMIZE_QUALITY = getattr(CONFIG, "IMAGE_OPTIMIZE_QUALITY", 80)
+# 0 keeps the original width
+IMAGE_MAX_WIDTH = getattr(CONFIG, "IMAGE_MAX_WIDTH", 0)
+IMAGE_OPTIMIZE_WORKERS = getattr(CONFIG, "IMAGE_OPTIMIZE_WORKERS", os.cpu_count())
+
+EXTENSIONS = {"webp": ".webp", "jpeg": ".jpg"}
+CONTENT_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+optimize_executor = None
+optimize_executor_lock = threading.Lock()
+
+
+def optimize_image_bytes(content: bytes, fmt: str, quality: int, max_width: int):
+    image = Image.open(io.BytesIO(content))
+    if getattr(image, "n_frames", 1) > 1:
+        # Animated images would lose their frames
+        return None
+
+    if max_width and image.width > max_width:
+        height = round(image.height * max_width / image.width)
+        image = image.resize((max_width, height), Image.LANCZOS)
+
+    if fmt == "jpeg" and image.mode != "RGB":
+        image = image.convert("RGB")
+    elif fmt == "webp" and image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.mode else "RGB")
+
+    # Saving without exif drops the camera/editor metadata, the colour profile
+    # is kept so colours do not shift
+    output = io.BytesIO()
+    image.save(
+        output,
+        format=fmt.upper(),
+        quality=quality,
+        optimize=fmt == "jpeg",
+        progressive=fmt == "jpeg",
+        icc_profile=image.info.get("icc_profile"),
+    )
+    return output.getvalue()
+
+
+def optimize_image_file(
+    src_path: str, dst_path: str, fmt: str, quality: int, max_width: int
+):
+    with open(src_path, "rb") as f:
+        content = optimize_image_bytes(f.read(), fmt, quality, max_width)
+    if content is None:
+        return src_path
+
+    tmp_path = f"{dst_path}.part"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+
+class Optimizer:
+    def is_enabled(self) -> bool:
+        return IMAGE_OPTIMIZE_FORMAT in EXTENSIONS
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        # Re-encoding is CPU bound, so it runs outside the crawler process
+        global optimize_executor
+        with optimize_executor_lock:
+            if optimize_executor is None:
+                # Forking a process that runs download threads can deadlock
+                optimize_executor = ProcessPoolExecutor(
+                    max_workers=IMAGE_OPTIMIZE_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+        return optimize_executor
+
+    def get_optimized_path(self, image_path: str) -> str:
+        # The original is kept next to it, so save_image can still skip it
+        root, extension = os.path.splitext(image_path)
+        optimized_extension = EXTENSIONS[IMAGE_OPTIMIZE_FORMAT]
+        if extension == optimized_extension:
+            return f"{root}.min{optimized_extension}"
+        return root + optimized_extension
+
+    def optimize_file(self, image_path: str) -> str:
+        optimized_path = self.get_optimized_path(image_path)
+        if os.path.isfile(optimized_path):
+            return optimized_path
+
+        try:
+            future = self.get_executor().submit(
+                optimize_image_file,
+                image_path,
+                optimized_path,
+                IMAGE_OPTIMIZE_FORMAT,
+                IMAGE_OPTIMIZE_QUALITY,
+                IMAGE_MAX_WIDTH,
+            )
+            return future.result()
+        except Exception as e:
+            logging.error(f"[-] Cannot optimize {image_path}: {e}")
+            return image_path
+
+    def optimize_bytes(self, content: bytes) -> tuple:
+        try:
+            future = self.get_executor().submit(
+                optimize_image_bytes,
+                content,
+                IMAGE_OPTIMIZE_FORMAT,
+                IMAGE_OPTIMIZE_QUALITY,
+                IMAGE_MAX_WIDTH,
+            )
+            optimized = future.result()
+        except Exception as e:
+            logging.error(f"[-] Cannot optimize image: {e}")
+            return content, ""
+
+        if optimized is None:
+            return content, ""
+        return optimized, IMAGE_OPTIMIZE_FORMAT
+
+
+_optimizer = Optimizer()
@@ -0,0 +1,124 @@
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+
+from settings import CONFIG
+
+PROFILE_PATH = getattr(CONFIG, "PROFILE_PATH", "log/profile")
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # "outer;inner" -> microseconds spent in inner itself, the folded
+        # stacks format of flamegraph.pl / inferno / speedscope
+        self.stacks = {}
+        # Before Python 3.12 cProfile only sees its own thread, worker threads
+        # add theirs here
+        self.thread_profiles = []
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def span(self, func):
+        name = func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+
+            stack = getattr(self.local, "stack", None)
+            if stack is None:
+                stack = self.local.stack = []
+
+            # [name, seconds spent in nested spans]
+            stack.append([name, 0.0])
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                path = ";".join(frame[0] for frame in stack)
+                _, children = stack.pop()
+                if stack:
+                    stack[-1][1] += elapsed
+                with self.lock:
+                    self.stacks[path] = self.stacks.get(path, 0) + int(
+                        (elapsed - children) * 1_000_000
+                    )
+
+        return wrapper
+
+    @contextmanager
+    def profile_thread(self):
+        # From Python 3.12 cProfile runs on sys.monitoring, which is
+        # process-wide: the profile_pass one already sees every thread and a
+        # second Profile raises "Another profiling tool is already active"
+        if not self.enabled or sys.version_info >= (3, 12):
+            yield
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self.lock:
+                self.thread_profiles.append(profile)
+
+    @contextmanager
+    def profile_pass(self, script: str):
+        # One .prof (cProfile, for snakeviz / pstats) and one .folded (spans,
+        # for flamegraphs) per pass
+        if not self.enabled:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.dump(script, profile)
+
+    def dump(self, script: str, profile: cProfile.Profile) -> None:
+        Path(PROFILE_PATH).mkdir(parents=True, exist_ok=True)
+        prefix = os.path.join(
+            PROFILE_PATH, f"{script}-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        )
+
+        with self.lock:
+            thread_profiles, self.thread_profiles = self.thread_profiles, []
+            stacks, self.stacks = self.stacks, {}
+
+        stats = pstats.Stats(profile)
+        for thread_profile in thread_profiles:
+            stats.add(thread_profile)
+        stats.dump_stats(f"{prefix}.prof")
+
+        with open(f"{prefix}.folded", "w") as f:
+            for path, microseconds in sorted(stacks.items()):
+                print(f"{path} {microseconds}", file=f)
+
+        logging.info(f"[+] Profile written to {prefix}.prof and {prefix}.folded")
+
+
+_profiler = Profiler()
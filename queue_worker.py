@@ -0,0 +1,109 @@
+import argparse
+import logging
+import multiprocessing
+from functools import partial
+from time import sleep
+
+from _db import Database
+from chapter import ChapterRecord
+from crawler import Crawler
+from fingerprint import _fingerprint
+from job_queue import PRIORITY_UPDATE, JobQueue
+from metrics import METRICS_PORT, _metrics
+from settings import CONFIG
+
+logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s", level=logging.INFO)
+
+QUEUE_WORKERS = getattr(CONFIG, "QUEUE_WORKERS", 4)
+
+
+def enqueue_comic(
+    job_queue: JobQueue, priority: int, href: str, listing_fingerprint: str = ""
+) -> bool:
+    job_queue.put_comic(priority, href=href, listing_fingerprint=listing_fingerprint)
+    # Not crawled yet, so the comic is not marked as done
+    return False
+
+
+def enqueue_chapter(
+    job_queue: JobQueue, priority: int, chapter: ChapterRecord, **kwargs
+) -> bool:
+    job_queue.put_chapter(priority, chapter=chapter.to_dict(), **kwargs)
+    # The queue retries the chapter from here on, the comic job is complete
+    return True
+
+
+def run_job(_crawler: Crawler, job_queue: JobQueue, job) -> None:
+    if job.type == "page":
+        is_crawled = _crawler.crawl_page(
+            page=job.payload["page"],
+            crawl_comic=partial(enqueue_comic, job_queue, job.priority),
+        )
+    elif job.type == "comic":
+        is_crawled = _crawler.crawl_comic(
+            **job.payload,
+            crawl_chapter=partial(enqueue_chapter, job_queue, job.priority),
+            # Queued in this order, equal priorities run oldest queued first
+            newest_first=job.priority >= PRIORITY_UPDATE,
+        )
+    elif job.type == "chapter":
+        is_crawled = _crawler.crawl_chapter(
+            **{**job.payload, "chapter": ChapterRecord(**job.payload["chapter"])}
+        )
+    else:
+        raise Exception(f"Unknown job type {job.type}")
+
+    if not is_crawled:
+        raise Exception(f"Failed to crawl {job.type} {job.payload}")
+
+
+def worker(index: int) -> None:
+    # One endpoint per process, after the queue's own
+    _metrics.serve(METRICS_PORT + 3 + index if METRICS_PORT else 0)
+
+    database = Database()
+    _crawler = Crawler(database=database)
+    job_queue = JobQueue()
+
+    while True:
+        job = job_queue.get()
+        if not job:
+            sleep(1)
+            continue
+
+        try:
+            with _metrics.time("crawler_job_seconds", type=job.type):
+                run_job(_crawler, job_queue, job)
+            job_queue.done(job)
+            _metrics.inc("crawler_jobs_total", type=job.type, result="done")
+        except Exception as e:
+            _metrics.inc("crawler_jobs_total", type=job.type, result="failed")
+            logging.error(f"[-] Job {job.id} {job.type} failed: {e}")
+            is_failed = job_queue.fail(job, str(e))
+            if is_failed and job.type == "chapter":
+                # The comic job stored its fingerprint once the chapter was
+                # queued, drop it so the next pass queues the chapter again
+                _fingerprint.delete(job.payload["comic_slug"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=QUEUE_WORKERS)
+    args = parser.parse_args()
+
+    # Spawned, so no worker inherits the parent's sockets or SQLite handles
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=worker, args=(index,)) for index in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    _metrics.set_gauge("crawler_jobs", JobQueue().get_depth)
+    _metrics.serve(METRICS_PORT + 2 if METRICS_PORT else 0)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
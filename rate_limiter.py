@@ -0,0 +1,114 @@
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import monotonic
+from urllib.parse import urlsplit
+
+from settings import CONFIG
+
+# Requests per second a host starts at and the range it may move in
+RATE_LIMIT_INITIAL = getattr(CONFIG, "RATE_LIMIT_INITIAL", 4)
+RATE_LIMIT_MIN = getattr(CONFIG, "RATE_LIMIT_MIN", 0.2)
+RATE_LIMIT_MAX = getattr(CONFIG, "RATE_LIMIT_MAX", 50)
+# Requests sent back to back before the rate applies
+RATE_LIMIT_BURST = getattr(CONFIG, "RATE_LIMIT_BURST", 4)
+# Additive increase: requests per second gained per second of healthy traffic
+RATE_LIMIT_INCREASE = getattr(CONFIG, "RATE_LIMIT_INCREASE", 0.5)
+# Multiplicative decrease on 429 / 5xx / connection errors / slow responses
+RATE_LIMIT_DECREASE = getattr(CONFIG, "RATE_LIMIT_DECREASE", 0.5)
+# A response slower than this (seconds to headers) counts as a warning
+RATE_LIMIT_SLOW_RESPONSE = getattr(CONFIG, "RATE_LIMIT_SLOW_RESPONSE", 5)
+# Longest Retry-After honoured, in seconds
+RATE_LIMIT_MAX_WAIT = getattr(CONFIG, "RATE_LIMIT_MAX_WAIT", 300)
+
+# Times a 429 / 503 response is retried once the host allows it again
+RATE_LIMIT_RETRIES = getattr(CONFIG, "RATE_LIMIT_RETRIES", 3)
+
+THROTTLED_STATUSES = {429, 500, 502, 503, 504}
+RETRY_STATUSES = {429, 503}
+
+
+class HostLimit:
+    def __init__(self) -> None:
+        self.rate = RATE_LIMIT_INITIAL
+        # Theoretical arrival time of the next request (GCRA token bucket)
+        self.next_at = 0.0
+        self.blocked_until = 0.0
+        self.decreased_at = 0.0
+
+
+class RateLimiter:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def get_limit(self, url: str) -> HostLimit:
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = HostLimit()
+        return self.hosts[host]
+
+    def reserve(self, url: str) -> float:
+        # Takes a slot for url's host and returns the seconds to wait for it,
+        # so threads can sleep() and coroutines asyncio.sleep() on it
+        with self.lock:
+            limit = self.get_limit(url)
+            now = monotonic()
+            interval = 1 / limit.rate
+            next_at = max(limit.next_at, now)
+            delay = max(
+                0,
+                next_at - (RATE_LIMIT_BURST - 1) * interval - now,
+                limit.blocked_until - now,
+            )
+            limit.next_at = max(next_at, now + delay) + interval
+            return delay
+
+    def get_retry_after(self, headers) -> float:
+        value = (headers or {}).get("Retry-After")
+        if not value:
+            return 0
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return 0
+            seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+        return min(max(seconds, 0), RATE_LIMIT_MAX_WAIT)
+
+    def feedback(
+        self, url: str, status: int = None, elapsed: float = 0, headers=None
+    ) -> None:
+        # status None means the request did not get a response at all
+        is_throttled = status is None or status in THROTTLED_STATUSES
+        retry_after = self.get_retry_after(headers) if is_throttled else 0
+
+        with self.lock:
+            limit = self.get_limit(url)
+            now = monotonic()
+            if retry_after:
+                limit.blocked_until = max(limit.blocked_until, now + retry_after)
+
+            if is_throttled or elapsed > RATE_LIMIT_SLOW_RESPONSE:
+                # Requests already in flight fail together, back off once for them
+                if now - limit.decreased_at >= 1 / limit.rate:
+                    limit.rate = max(RATE_LIMIT_MIN, limit.rate * RATE_LIMIT_DECREASE)
+                    limit.decreased_at = now
+            else:
+                limit.rate = min(
+                    RATE_LIMIT_MAX, limit.rate + RATE_LIMIT_INCREASE / limit.rate
+                )
+
+    def get_interval(self, url: str) -> float:
+        # Seconds between two requests to url's host at its current rate
+        with self.lock:
+            return 1 / self.get_limit(url).rate
+
+    def get_rates(self) -> dict:
+        with self.lock:
+            return {host: limit.rate for host, limit in self.hosts.items()}
+
+
+_rate_limiter = RateLimiter()
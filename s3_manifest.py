@@ -0,0 +1,39 @@
+from settings import CONFIG
+from sqlite_store import SqliteStore
+
+S3_MANIFEST_DB = getattr(CONFIG, "S3_MANIFEST_DB", "data/s3_manifest.sqlite3")
+
+
+class S3Manifest(SqliteStore):
+    def __init__(self, path: str = S3_MANIFEST_DB) -> None:
+        # name is the key without its extension, which is only known after
+        # the image was downloaded
+        super().__init__(
+            path, "CREATE TABLE IF NOT EXISTS uploads (name TEXT PRIMARY KEY, key TEXT)"
+        )
+
+    def get(self, name: str) -> str:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT key FROM uploads WHERE name = ?", (name,)
+            ).fetchone()
+
+        return row[0] if row else ""
+
+    def set(self, name: str, key: str) -> None:
+        self.write(
+            "INSERT OR REPLACE INTO uploads (name, key) VALUES (?, ?)", (name, key)
+        )
+
+    def delete(self, names: list) -> None:
+        self.write(
+            "DELETE FROM uploads WHERE name = ?",
+            [(name,) for name in names],
+            many=True,
+        )
+
+    def clear(self) -> None:
+        self.write("DELETE FROM uploads")
+
+
+_s3_manifest = S3Manifest()
@@ -0,0 +1,32 @@
+import sqlite3
+import threading
+from pathlib import Path
+
+from settings import CONFIG
+
+# Seconds a statement waits for another process's write before it fails
+SQLITE_TIMEOUT = getattr(CONFIG, "SQLITE_TIMEOUT", 60)
+
+
+class SqliteStore:
+    # A small SQLite file shared by update.py, the crawl_all.py threads and
+    # the queue workers. WAL lets readers run next to a writer and the busy
+    # timeout waits out the other processes' writes
+    def __init__(self, path: str, *schema: str) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, timeout=SQLITE_TIMEOUT, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        for statement in schema:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def write(self, query: str, params=(), many: bool = False) -> None:
+        with self.lock:
+            if many:
+                self.conn.executemany(query, params)
+            else:
+                self.conn.execute(query, params)
+            self.conn.commit()
@@ -1,30 +1,55 @@
+import logging
 import sys
 from time import sleep
 
 from icecream import ic
 
 from _db import Database
+from async_crawler import AsyncCrawler
 from crawler import Crawler
+from job_queue import PRIORITY_UPDATE, JobQueue
+from metrics import _metrics
+from profiler import _profiler
 from settings import CONFIG
 from telegram_noti import send_direct_message
 
+# One pooled Database for the whole process, it reconnects by itself when
+# MariaDB drops the connection between passes
+database_for_update = Database()
+
 
 def main():
-    database_for_update = Database()
+    since = _metrics.snapshot()
     print(f"Using database: {database_for_update} for update.py file...")
-    _crawler = Crawler(database=database_for_update)
+    if "--async" in sys.argv:
+        _crawler = AsyncCrawler(database=database_for_update, newest_first=True)
+    else:
+        _crawler = Crawler(database=database_for_update, newest_first=True)
 
     try:
         is_netttruyen_domain_work = _crawler.is_nettruyen_domain_work()
         if not is_netttruyen_domain_work:
             send_direct_message(msg="Nettruyen domain might be changed!!!")
             sys.exit(1)
-        _crawler.crawl_page(page=1)
+        if "--queue" in sys.argv:
+            # queue_worker.py does the crawling, ahead of the backfill
+            JobQueue().put_page(1, PRIORITY_UPDATE)
+        elif "--async" in sys.argv:
+            _crawler.run(pages=[1])
+        else:
+            _crawler.crawl_page(page=1)
     except Exception as e:
         ic(e)
+        _metrics.inc("crawler_pass_errors_total", script="update")
+
+    logging.info(f"[+] Pass summary:\n{_metrics.get_summary(since)}")
 
 
 if __name__ == "__main__":
+    _metrics.serve()
+    if "--profile" in sys.argv:
+        _profiler.enable()
     while True:
-        main()
+        with _profiler.profile_pass("update"):
+            main()
         sleep(CONFIG.WAIT_BETWEEN_LATEST)